@@ -2,20 +2,31 @@
 import os 
 import gzip
 import time
+import subprocess
+from math import log, sqrt
 from sys import exit  
+import sys
 import shutil
-from tkinter import *
-from tkinter import filedialog 
-from tkinter.filedialog import askdirectory
-from Bio import SeqIO
 import numpy as np 
 from numpy import mean
-import matplotlib.pyplot as plt
 import datetime 
 import argparse
+import json
+import csv
+import hashlib
+import tempfile
+import sqlite3
+import traceback
+import threading
+import fcntl
+from collections import namedtuple
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 
-PARSER = argparse.ArgumentParser(description = """
+def Pipeline_Parser():
+	# command line of the pipeline, built on demand so the module can be imported as a library
+	PARSER = argparse.ArgumentParser(description = """
 COMMAND LINE TOOL FOR AUTOMATING MULTI-FILE PROCESSING OF MINION NGS DATA  
 AUTHOR: RICARDO JORGE PAIS @ INSA    
 DATE OF LAST UPDATE: 14/4/2021
@@ -44,297 +55,1009 @@ Example:  -g choose -s choose -i choose.
 You can also set most pipeline parameters for tuning the analysis by adding adicional arguments.
 If not defaut settings will be applied.
 
+Coverage plots saved with --plots deferred can be drawn later with the render-plots command:
+    python AMP_TELEvir_CLI.py render-plots <samples folder>/<run name> [-j jobs] [--flagged]
+
+Runs given a --database store their samples and mutations in it, which is searched with the query command:
+    python AMP_TELEvir_CLI.py query <database> [--mutation A-->G] [--locus name] [--position n] [--sample ID] [--qc]
 
 """,  formatter_class= argparse.RawDescriptionHelpFormatter  ) 
 
-PARSER.add_argument( "--refgenome", "-g", help= "The path for the fasta file with the reference genome\n", required = True, dest = "REFGENOME", action = "store"  ) 
-PARSER.add_argument( "--samples", "-s", help= "The path for the folder where the sample reads are located\n", required = True, dest = "PATH", action = "store"  ) 
-PARSER.add_argument( "--metadata", "-i", help= "The path for the file with files names and associated metadata\n", required = True, dest = "META", action = "store"  ) 
-PARSER.add_argument( "--version", "-v", action="version", version = "Alpha version 0.1 (April 2021) >>>> Ricardo J. Pais <<<< " ) 
-PARSER.add_argument( "--run_name", "-a", help= "Name of the folder containing the output results of the analysis (Default is set as miniON_Results)\n", type = str, required = False, dest = "RUN_NAME", action = "store", default="miniON_Results" ) 
-PARSER.add_argument( "--model_medaka", "-m", help= "Name of the medaka model available in medaka framework version 1.2 ( default = r941_min_high_g360)\n", type = str, required = False, dest = "MODEL", action = "store", default= "r941_min_high_g360" ) 
-PARSER.add_argument( "--cutoff1", "-c", help= "Sample coverage cutoff for masking variants and consensus ( default = 30)\n", type = int, required = False, dest = "CUTOFF1", action = "store", default= 30  ) 
-PARSER.add_argument( "--Ideal_coverage", "-b", help= "Ideal sample coverage for considering very high coverage ( default = 200). Note that cannot be lower than defined cutoff\n", type = int, required = False, dest = "IDEAL_COVERAGE", action = "store", default= 200 ) 
-PARSER.add_argument( "--minQ_Reads", "-q", help = "Cutoff for defining the minimum quality of reads to be filtered (q = -10 log[base error], default = 10, 0 ignores filter )\n", type = int, required = False, dest = "MINQREADS", action = "store", default= 10 ) 
-PARSER.add_argument( "--headcrop", "-e", help= "Length of inicial read sequence to crop (default = 70 )\n", type = int, required = False, dest = "HEADCROP", action = "store", default= 70 ) 
-PARSER.add_argument( "--tailcrop", "-t", help= "Length of final read sequence to crop (default = 70 )\n", type = int, required = False, dest = "TAILCROP", action = "store", default= 70 ) 
-PARSER.add_argument( "--minRlength", "-l", help= "Minimum length of the sequence for considering the read after cropping (default = 50 )\n", type = int, required = False, dest = "MINRLENGHT", action = "store", default= 50 ) 
-PARSER.add_argument( "--minFrequency", "-f", help= "Minimum base frequency threshold for considering a putative variants (default = 0.8 )\n", type = float, required = False, dest = "MINFREQ", action = "store", default= 0.8 ) 
-PARSER.add_argument( "--maxINDEL", "-d", help= "Maximum number of insertions and deletions allowed to be consider true, higher numbers are considered as gaps and ignored\n", type = int, required = False, dest = "MAXINDEL", action = "store", default= 10*9) 
-PARSER.add_argument( "--Ignore_Regions", "-u", help= "Input specific regions for ignoring across the sequence. This will mask and ignore variants on these regions. Not working in this version.\n Example for ignoring first 100 bases on locus 1,2 and 3 ...  -u 1:10-100;2:1-100;3:1-100\n", type = str, required = False, dest = "IGNORE_REGIONS", action = "store", default = "none" ) 
-PARSER.add_argument( "--minReads", "-n", help= "Miminum number of reads for processing data and generating results (default = 100)\n", type = int, required = False, dest = "MINREADSN", action = "store", default= 100 ) 
-PARSER.add_argument( "--minSeqCov", "-p", help= "Miminum sequence coverage (in percentage) to consider results robust  (default = 70)\n", type = int, required = False, dest = "MINSEQCOV", action = "store", default= 70 ) 
-ARGS = PARSER.parse_args() 
+	PARSER.add_argument( "--refgenome", "-g", help= "The path for the fasta file with the reference genome\n", required = True, dest = "REFGENOME", action = "store"  ) 
+	PARSER.add_argument( "--samples", "-s", help= "The path for the folder where the sample reads are located (fastq/fq files, gzipped or not, or barcode folders of fastq chunks)\n", required = True, dest = "PATH", action = "store"  ) 
+	PARSER.add_argument( "--metadata", "-i", help= "The path for the file with files names and associated metadata\n", required = True, dest = "META", action = "store"  ) 
+	PARSER.add_argument( "--version", "-v", action="version", version = "Alpha version 0.1 (April 2021) >>>> Ricardo J. Pais <<<< " ) 
+	PARSER.add_argument( "--run_name", "-a", help= "Name of the folder containing the output results of the analysis (Default is set as miniON_Results)\n", type = str, required = False, dest = "RUN_NAME", action = "store", default="miniON_Results" ) 
+	PARSER.add_argument( "--model_medaka", "-m", help= "Name of the medaka model available in medaka framework version 1.2 ( default = r941_min_high_g360)\n", type = str, required = False, dest = "MODEL", action = "store", default= "r941_min_high_g360" ) 
+	PARSER.add_argument( "--cutoff1", "-c", help= "Sample coverage cutoff for masking variants and consensus ( default = 30)\n", type = int, required = False, dest = "CUTOFF1", action = "store", default= 30  ) 
+	PARSER.add_argument( "--Ideal_coverage", "-b", help= "Ideal sample coverage for considering very high coverage ( default = 200). Note that cannot be lower than defined cutoff\n", type = int, required = False, dest = "IDEAL_COVERAGE", action = "store", default= 200 ) 
+	PARSER.add_argument( "--minQ_Reads", "-q", help = "Cutoff for defining the minimum quality of reads to be filtered (q = -10 log[base error], default = 10, 0 ignores filter )\n", type = int, required = False, dest = "MINQREADS", action = "store", default= 10 ) 
+	PARSER.add_argument( "--headcrop", "-e", help= "Length of inicial read sequence to crop (default = 70 )\n", type = int, required = False, dest = "HEADCROP", action = "store", default= 70 ) 
+	PARSER.add_argument( "--tailcrop", "-t", help= "Length of final read sequence to crop (default = 70 )\n", type = int, required = False, dest = "TAILCROP", action = "store", default= 70 ) 
+	PARSER.add_argument( "--minRlength", "-l", help= "Minimum length of the sequence for considering the read after cropping (default = 50 )\n", type = int, required = False, dest = "MINRLENGHT", action = "store", default= 50 ) 
+	PARSER.add_argument( "--minFrequency", "-f", help= "Minimum base frequency threshold for considering a putative variants (default = 0.8 )\n", type = float, required = False, dest = "MINFREQ", action = "store", default= 0.8 ) 
+	PARSER.add_argument( "--maxINDEL", "-d", help= "Maximum number of insertions and deletions allowed to be consider true, higher numbers are considered as gaps and ignored\n", type = int, required = False, dest = "MAXINDEL", action = "store", default= 10*9) 
+	PARSER.add_argument( "--Ignore_Regions", "-u", help= "Input specific regions for ignoring across the sequence. This will mask and ignore variants on these regions. Loci are given by their number in the reference or by name, or a BED file path can be given instead.\n Example for ignoring first 100 bases on locus 1,2 and 3 ...  -u 1:10-100;2:1-100;3:1-100\n", type = str, required = False, dest = "IGNORE_REGIONS", action = "store", default = "none" ) 
+	PARSER.add_argument( "--minReads", "-n", help= "Miminum number of reads for processing data and generating results (default = 100)\n", type = int, required = False, dest = "MINREADSN", action = "store", default= 100 ) 
+	PARSER.add_argument( "--minSeqCov", "-p", help= "Miminum sequence coverage (in percentage) to consider results robust  (default = 70)\n", type = int, required = False, dest = "MINSEQCOV", action = "store", default= 70 ) 
+	PARSER.add_argument( "--mafft_alignment", "-x", help= "Align each consensus sequence to the reference with mafft instead of deriving the alignment from the variants (slower, for validation)\n", required = False, dest = "MAFFT", action = "store_true" ) 
+	PARSER.add_argument( "--ref_cache", "-r", help= "Private folder (created 0700, owned by the user) for the reference indexes cache, named by the reference content so the runs of the user with the same reference reuse it, and for the reads statistics reused by later runs (default = AMPnano_reference_cache_<uid> in the system temporary folder)\n", type = str, required = False, dest = "REFCACHE", action = "store", default= os.path.join(tempfile.gettempdir(), "AMPnano_reference_cache_" + str(os.getuid())) ) 
+	PARSER.add_argument( "--resume", "-k", help= "Carry on an existing analysis (same run name): finished samples are skipped and unfinished ones restart at their first incomplete step\n", required = False, dest = "RESUME", action = "store_true" ) 
+	PARSER.add_argument( "--jobs", "-j", help= "Number of samples processed in parallel. The available cores are split between jobs for the medaka threads (default = 1)\n", type = int, required = False, dest = "JOBS", action = "store", default= 1 ) 
+	PARSER.add_argument( "--depth_engine", "-z", help= "How the sample depth is computed from the medaka alignments: samtools depth, in-process with pysam (no samtools needed, also used for the reference faidx), or auto (pysam when installed) (default = samtools)\n", type = str, required = False, dest = "DEPTH_ENGINE", action = "store", default= "samtools", choices = ["samtools", "pysam", "auto"] )
+	PARSER.add_argument( "--columnar", "-w", help= "Also write the report and mutation rows of each sample as columnar files for aggregation over many runs, in <run name>/Columnar/ (parquet or arrow IPC, needs pip install pyarrow) (default = none)\n", type = str, required = False, dest = "COLUMNAR", action = "store", default= "none", choices = ["none", "parquet", "arrow"] )
+	PARSER.add_argument( "--database", "-y", help= "SQLite file gathering the mutations and QC stats of the samples of all runs given it, searched with the query command (created when missing, default = none)\n", type = str, required = False, dest = "DATABASE", action = "store", default= "none" )
+	PARSER.add_argument( "--plots", "-o", help= "Coverage plots to draw: all samples, only flagged samples (not enough sequence coverage), none, or deferred (the plot data is saved and drawn in a separate process pool, or later with render-plots) (default = all)\n", type = str, required = False, dest = "PLOTS", action = "store", default= "all", choices = ["all", "flagged", "none", "deferred"] )
+	return PARSER
+
+
+def Render_Parser():
+	RENDER_PARSER = argparse.ArgumentParser( prog = "AMP_TELEvir_CLI.py render-plots", description = "Draws the coverage plots of the samples of an analysis run with --plots deferred" )
+	RENDER_PARSER.add_argument( "RUN", help= "The results folder of the analysis (<samples folder>/<run name>)\n", action = "store" )
+	RENDER_PARSER.add_argument( "--flagged", "-f", help= "Draw only the samples with the not enough sequence coverage warning\n", required = False, dest = "FLAGGED", action = "store_true" )
+	RENDER_PARSER.add_argument( "--jobs", "-j", help= "Number of plots drawn in parallel (default = 1)\n", type = int, required = False, dest = "JOBS", action = "store", default= 1 )
+	return RENDER_PARSER
+
+
+def Query_Parser():
+	QUERY_PARSER = argparse.ArgumentParser( prog = "AMP_TELEvir_CLI.py query", description = "Searches the mutations (or with --qc the sample QC stats) of the runs stored in a --database file, written as csv" )
+	QUERY_PARSER.add_argument( "DATABASE", help= "The database file given to the runs with --database\n", action = "store" )
+	QUERY_PARSER.add_argument( "--mutation", "-m", help= "Mutation, as in Detected_Mutations.csv (e.g. A-->G)\n", required = False, dest = "MUTATION", action = "store" )
+	QUERY_PARSER.add_argument( "--locus", "-l", help= "Reference sequence (locus) name\n", required = False, dest = "LOCUS", action = "store" )
+	QUERY_PARSER.add_argument( "--position", "-p", help= "Position in the locus\n", type = int, required = False, dest = "POSITION", action = "store" )
+	QUERY_PARSER.add_argument( "--sample", "-s", help= "Sample ID (name of the reads file)\n", required = False, dest = "SAMPLE", action = "store" )
+	QUERY_PARSER.add_argument( "--run", "-r", help= "Run name\n", required = False, dest = "RUN", action = "store" )
+	QUERY_PARSER.add_argument( "--qc", "-q", help= "List the QC stats of the samples instead of their mutations\n", required = False, dest = "QC", action = "store_true" )
+	return QUERY_PARSER
+
+
+class ToolError(Exception):
+	"""External tool of the pipeline exited with a non zero status (the sample is reported as failed)"""
+
+
+TIMINGS = []   # [name, kind, wall s, cpu s, peak rss MB or None] of the steps and commands of the sample being processed
+TIMING_FIELDS = ["sample", "name", "kind", "wall_s", "cpu_s", "peak_rss_mb"]
+
+
+def Process_Times():
+	# [wall time, cpu time of the process and of its finished children]
+	t = os.times()
+	return [time.time(), t.user + t.system + t.children_user + t.children_system]
+
+
+def Reset_Peak_RSS():
+	# resets the peak RSS (VmHWM) of the process, on Linux only; False where it cannot be reset
+	try:
+		with open("/proc/self/clear_refs", "w") as f:
+			f.write("5")
+		return True
+	except OSError:
+		return False
+
+
+def Peak_RSS():
+	# peak RSS of the process in MB since the last reset (VmHWM)
+	with open("/proc/self/status") as f:
+		for line in f:
+			if line.startswith("VmHWM:"):
+				return round(int(line.split()[1])/1024, 1)
+	return None
+
+
+def Step_Clock():
+	# [wall time, cpu time, peak RSS reset] at the start of a step
+	return Process_Times() + [Reset_Peak_RSS()]
+
+
+def Record_Step(name, clock):
+	# times an in process step started at clock; its peak RSS is left empty where it could not be reset at the start
+	peak = Peak_RSS() if clock[2] else None
+	now = Process_Times()
+	TIMINGS.append([name, "step", round(now[0] - clock[0], 3), round(now[1] - clock[1], 3), peak])
+	return TIMINGS[-1]
+
+
+def Process_Tree(root):
+	# pids of root and of its live descendants, from /proc (the children lists, or else the parent pid of every process)
+	if os.path.exists("/proc/" + str(root) + "/task/" + str(root) + "/children"):
+		CHILDREN = None
+	else:
+		CHILDREN = {}
+		for entry in os.listdir("/proc"):
+			try:
+				with open("/proc/" + entry + "/stat") as f:
+					ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+				CHILDREN.setdefault(ppid, []).append(int(entry))
+			except (OSError, ValueError, IndexError):
+				continue
+	TREE, PIDS = [], [root]
+	while len(PIDS) > 0:
+		pid = PIDS.pop()
+		TREE.append(pid)
+		if CHILDREN != None:
+			PIDS.extend(CHILDREN.get(pid, []))
+			continue
+		try:
+			for task in os.listdir("/proc/" + str(pid) + "/task"):
+				with open("/proc/" + str(pid) + "/task/" + task + "/children") as f:
+					PIDS.extend([ int(child) for child in f.read().split() ])
+		except OSError:
+			continue
+	return TREE
+
+
+def Sample_Command_RSS(root, done, peak, interval = 0.2):
+	# polls the VmHWM of the processes of a running command (each one since its exec, unlike ru_maxrss, which
+	# carries over the peak of the python process that started it) until done is set
+	# peak = [largest VmHWM in kB, number of polls]
+	while True:
+		for pid in Process_Tree(root):
+			try:
+				with open("/proc/" + str(pid) + "/status") as f:
+					for line in f:
+						if line.startswith("VmHWM:"):
+							peak[0] = max(peak[0], int(line.split()[1]))
+			except OSError:
+				continue
+		peak[1] = peak[1] + 1
+		if done.wait(interval):
+			return
+
+
+def Run_Command(commands, tool, output = None):
+	# runs the shell command once, returns [exit status, stderr, elapsed seconds] and raises ToolError on failure
+	# the command is waited with wait4, so its own cpu time (with its children) is recorded in TIMINGS; its peak RSS is
+	# the largest VmHWM of its processes, polled from /proc while it runs, and is left empty for a command too short
+	# to be polled twice (or without /proc)
+	# with output, the command stdout is passed to it block by block (stderr is kept in a temporary file meanwhile)
+	start = time.time()
+	if output == None:
+		process = subprocess.Popen(commands, shell = True, stderr = subprocess.PIPE, universal_newlines = True)
+	else:
+		errors = tempfile.TemporaryFile()
+		process = subprocess.Popen(commands, shell = True, stdout = subprocess.PIPE, stderr = errors)
+	done, peak = threading.Event(), [0, 0]
+	if os.path.isdir("/proc"):
+		sampler = threading.Thread(target = Sample_Command_RSS, args = (process.pid, done, peak), daemon = True)
+		sampler.start()
+	try:
+		if output == None:
+			stderr = process.stderr.read()
+			process.stderr.close()
+		else:
+			try:
+				for block in iter(lambda: process.stdout.read(1 << 20), b""):
+					output(block)
+			except BaseException:
+				process.kill()
+				process.wait()
+				errors.close()
+				raise
+			process.stdout.close()
+		status, usage = os.wait4(process.pid, 0)[1:]
+	finally:
+		done.set()
+	if output != None:
+		errors.seek(0)
+		stderr = errors.read().decode(errors = "replace")
+		errors.close()
+	process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+	elapsed = time.time() - start
+	TIMINGS.append([tool, "command", round(elapsed, 3), round(usage.ru_utime + usage.ru_stime, 3), round(peak[0]/1024, 1) if peak[1] > 1 and peak[0] > 0 else None])
+	if process.returncode != 0:
+		raise ToolError("Fail to run " + tool + " commands (exit status " + str(process.returncode) + ")\n please ensure that the tool is installed\n" + stderr.strip()[-2000:])
+	return [process.returncode, stderr, elapsed]
+
+READS_EXTENSIONS = (".fastq.gz", ".fq.gz", ".fastq", ".fq")
 
 
 def Get_Sample_IDname (filepath):
-	name = filepath.split(".")[0].split("/")[-1]
+	# name of the reads file without its fastq extension (or of the folder of fastq chunks)
+	name = os.path.basename(filepath.rstrip("/"))
+	for extension in READS_EXTENSIONS:
+		if name.endswith(extension):
+			return name[:-len(extension)]
 	return name
 
 
-def Medaka_consensus_prediction(samplepath ,refpath, model, Output_path):
+def Reads_Files(path):
+	# the fastq file of a sample, or the fastq chunks of a barcode folder in name order (as MinKNOW writes them)
+	if not os.path.isdir(path):
+		return [path]
+	with os.scandir(path) as entries:
+		return sorted([ entry.path for entry in entries if entry.name.endswith(READS_EXTENSIONS) and entry.is_file() ])
+
+
+def Reads_Signature(path):
+	# [number of files, total size, latest mtime] of the reads of a sample, to tell when they changed
+	infos = [ os.stat(File) for File in Reads_Files(path) ]
+	return [ len(infos), sum([ info.st_size for info in infos ]), max([ info.st_mtime_ns for info in infos ] + [0]) ]
+
+
+def Discover_Samples(path, metadata):
+	# reads of the samples listed in the metadata, from a single scandir of the samples folder (entries keep their stat)
+	# a listed name can be a fastq file (.fastq, .fq, gzip or not) or a folder of fastq chunks, which is also
+	# found from the name of a fastq file (barcode01.fastq.gz -> barcode01/)
+	# returns [[[file name, reads path], ...] in metadata order, [file names without reads]]
+	with os.scandir(path) as entries:
+		ENTRIES = { entry.name: entry for entry in entries }
+	found, missing, seen = [], [], set()
+	for FileName in metadata["FileName"]:
+		if FileName in seen:
+			continue
+		seen.add(FileName)
+		entry = ENTRIES.get(FileName)
+		if entry == None or not (entry.is_dir() or FileName.endswith(READS_EXTENSIONS)):
+			entry = ENTRIES.get(Get_Sample_IDname(FileName))
+		if entry != None and entry.is_file() and entry.name.endswith(READS_EXTENSIONS):
+			found.append([FileName, entry.path])
+		elif entry != None and entry.is_dir() and len(Reads_Files(entry.path)) > 0:
+			found.append([FileName, entry.path])
+		else:
+			missing.append(FileName)
+	return [found, missing]
+
+
+def Medaka_Outputs(Output_path):
+	# [bam, consensus probabilities, consensus] written by medaka_consensus in the output folder
+	return [Output_path + "/calls_to_draft.bam", Output_path + "/consensus_probs.hdf", Output_path + "/consensus.fasta"]
+
+
+def Medaka_consensus_prediction(samplepath ,refpath, model, Output_path, threads = 8):
 	I, M, R  = samplepath , model, refpath
 	O = Output_path  # output folder
-	output_exists = os.path.isdir(O)
-	if output_exists == True:
-		shutil.rmtree(O)
+	# only the outputs of an unfinished medaka run are removed (medaka would reuse them), the rest of the folder is kept
+	for stale in Medaka_Outputs(O) + [O + "/calls_to_draft.bam.bai", O + "/consensus.fasta.gaps_in_draft_coords.bed"]:
+		if os.path.exists(stale):
+			os.remove(stale)
 	if M == "default":
- 		commands =  "medaka_consensus -i "+ I +" -d "+ R +  " -o " + O
+ 		commands =  "medaka_consensus -i "+ I +" -d "+ R +  " -o " + O + " -t " + str(threads)
 	else:
- 		commands =  "medaka_consensus -i "+ I +" -d "+ R +  " -o " + O + " -t 8  -m " + M 
-	os.system(commands)
-	exist_status = os.system(commands)
-	if (exist_status != 0):
-		print('Fail to run medaka consensus tool commands\n please ensure medaka is installed and run again the pipeline')
-		exit(0)
-	bamFile = O + "/calls_to_draft.bam" 
-	ProbsFile = O + "/consensus_probs.hdf"
-	Consensus = O + "/consensus.fasta"
-	return [bamFile, ProbsFile, Consensus ]
-
-
-def CoverageExtraction(bam): 
-	Output_file = bam.split("calls_to_draft")[0] + "reads_coverage.depth"
-	commands =  "samtools depth -aa -d0 " + bam + " > " + Output_file 
-	os.system(commands)
-	exist_status = os.system(commands)
-	if (exist_status != 0):
-		print('Fail to run samtools commands\n please ensure that the tool is installed and run again the pipeline')
-		exit(0)		
-	return Output_file
+ 		commands =  "medaka_consensus -i "+ I +" -d "+ R +  " -o " + O + " -t " + str(threads) + "  -m " + M 
+	Run_Command(commands, "medaka consensus")
+	return Medaka_Outputs(O)
+
+
+def Module_Available(name):
+	# optional packages (pysam, pyarrow) are only imported where they are used
+	try:
+		__import__(name)
+	except ImportError:
+		return False
+	return True
+
+
+POWERS_OF_TEN = 10 ** np.arange(19, dtype = np.int64)
+CIGAR_REFERENCE = np.frombuffer(b"MDN=X", dtype = np.uint8)   # operations consuming the reference
+CIGAR_ALIGNED = np.frombuffer(b"M=X", dtype = np.uint8)       # operations counted in the depth
 
 
-def GunZip_Files ( FILES ):
-	for Output_file in FILES:
-		with open(Output_file, "rb") as initial:
-			with gzip.open(Output_file + ".gz", "wb" ) as zipped:  
-				zipped.writelines(initial)
+def Cigar_Blocks(starts, cigars):
+	# [block starts, block ends] (0 based, end excluded) of the aligned bases (M, = and X operations) of reads given by
+	# their reference start and CIGAR string, all the strings are parsed at once as a byte array
+	text = np.frombuffer("".join(cigars).encode(), dtype = np.uint8)
+	digit = (text >= 48) & (text <= 57)
+	ops = np.flatnonzero(~digit)
+	# each digit is weighted by its power of ten within the number ending at the next operation
+	run = np.cumsum(~digit)[digit]
+	weights = (text[digit] - 48).astype(np.int64) * POWERS_OF_TEN[ops[run] - np.flatnonzero(digit) - 1]
+	lengths = np.bincount(run, weights = weights, minlength = len(ops)).astype(np.int64)
+	codes = text[ops]
+	# operations of each read, from the string boundaries
+	ends = np.cumsum([ len(cigar) for cigar in cigars ])
+	first = np.searchsorted(ops, ends - np.array([ len(cigar) for cigar in cigars ]))
+	counts = np.diff(np.append(first, len(ops)))
+	advance = np.where(np.isin(codes, CIGAR_REFERENCE), lengths, 0)
+	offset = np.cumsum(advance) - advance
+	block_starts = np.repeat(np.array(starts, dtype = np.int64) - offset[first], counts) + offset
+	aligned = np.isin(codes, CIGAR_ALIGNED) & (lengths > 0)
+	return [block_starts[aligned], block_starts[aligned] + lengths[aligned]]
+
+
+def Add_Blocks(difference, starts, cigars, offset, grow):
+	# adds the aligned blocks of the reads to the difference array of a region starting at offset (0 based),
+	# the array grows when reads run past its end and grow is set, or the blocks are clipped to it
+	block_starts, block_ends = Cigar_Blocks(starts, cigars)
+	block_starts, block_ends = block_starts - offset, block_ends - offset
+	if grow and len(block_ends) > 0 and block_ends.max() >= len(difference):
+		difference = np.concatenate([ difference, np.zeros(int(block_ends.max()) - len(difference) + 1, dtype = np.int64) ])
+	n = len(difference) - 1
+	difference += np.bincount(np.clip(block_starts, 0, n), minlength = n + 1)
+	difference -= np.bincount(np.clip(block_ends, 0, n), minlength = n + 1)
+	return difference
+
+
+def Pysam_Depth(bam, regions = None, batch = 50000):
+	# in-process samtools depth -aa -d0 (pysam): every position of every contig, with the depth summed from a
+	# difference array over the aligned blocks of the reads (deletions and skipped bases are not counted, and
+	# unmapped, secondary, qc failed and duplicate reads are ignored, as samtools depth does by default)
+	# regions [[contig, start, end], ...] (1 based, inclusive) are read through the BAM index and reported alone
+	# returns the depth arrays {"contigs", "pos", "depth"}
+	import pysam
+	IGNORED = 0x4 | 0x100 | 0x200 | 0x400
+	with pysam.AlignmentFile(bam, "rb") as alignments:
+		WHOLE = regions == None
+		if WHOLE:
+			regions = [ [contig, 1, length] for contig, length in zip(alignments.references, alignments.lengths) ]
+		if WHOLE and not alignments.has_index():
+			# without an index all contigs are summed in a single pass over the file
+			SOURCES = [ [None, alignments.fetch(until_eof = True)] ]
+		else:
+			SOURCES = [ [r, alignments.fetch(contig, start - 1, end)] for r, (contig, start, end) in enumerate(regions) ]
+		REGION = { contig: r for r, (contig, start, end) in enumerate(regions) }
+		DIFFERENCE = [ np.zeros(end - start + 2, dtype = np.int64) for contig, start, end in regions ]
+		# the reads are parsed in batches of their reference starts and CIGAR strings
+		for region, reads in SOURCES:
+			BATCHES = {}
+			for read in reads:
+				if read.flag & IGNORED or read.cigarstring == None:
+					continue
+				r = region if region != None else REGION[read.reference_name]
+				starts, cigars = BATCHES.setdefault(r, [[], []])
+				starts.append(read.reference_start)
+				cigars.append(read.cigarstring)
+				if len(starts) == batch:
+					DIFFERENCE[r] = Add_Blocks(DIFFERENCE[r], starts, cigars, regions[r][1] - 1, WHOLE)
+					del BATCHES[r]
+			for r, (starts, cigars) in BATCHES.items():
+				DIFFERENCE[r] = Add_Blocks(DIFFERENCE[r], starts, cigars, regions[r][1] - 1, WHOLE)
+	DEPTH = { "contigs": [], "pos": [], "depth": [] }
+	for r, (contig, start, end) in enumerate(regions):
+		# like samtools, reads running past the contig end extend its positions
+		depth = np.cumsum(DIFFERENCE[r])[:-1].astype(np.int32)
+		n = max(end - start + 1, len(np.trim_zeros(depth, "b"))) if WHOLE else end - start + 1
+		DEPTH["contigs"].append(contig)
+		DEPTH["pos"].append(np.arange(start, start + n, dtype = np.int32))
+		DEPTH["depth"].append(depth[:n])
+	return DEPTH
+
+
+def Write_Depth(path, DEPTH):
+	# samtools depth style text (contig, position, depth), gzipped
+	with gzip.open(path, "wb") as zipped:
+		for contig, positions, depth in zip(DEPTH["contigs"], DEPTH["pos"], DEPTH["depth"]):
+			for b in range(0, len(positions), 1 << 16):
+				lines = [ contig + "\t" + str(p) + "\t" + str(d) + "\n" for p, d in zip(positions[b:b + (1 << 16)].tolist(), depth[b:b + (1 << 16)].tolist()) ]
+				zipped.write("".join(lines).encode())
+
+
+def CoverageExtraction(bam, engine = "samtools"): 
+	# samtools depth output is read from its stdout: each block is gzipped into reads_coverage.depth.gz and parsed
+	# into the depth arrays in the same pass, so the plain depth file is never written (returns [depth.gz, DEPTH])
+	# the pysam engine computes the same arrays in process and writes the depth.gz from them
+	Output_file = bam.split("calls_to_draft")[0] + "reads_coverage.depth.gz"
+	if engine == "pysam":
+		try:
+			DEPTH = Pysam_Depth(bam)
+		except (OSError, ValueError) as error:
+			raise ToolError("Fail to compute the depth of " + bam + " with pysam\n" + str(error))
+		Write_Depth(Output_file + ".tmp", DEPTH)
+		os.replace(Output_file + ".tmp", Output_file)
+		Save_Depth_Cache(Output_file + ".npz", DEPTH)
+		return [Output_file, DEPTH]
+	PARTS, rest = [], [b""]
+	def Parse_Block(block):
+		zipped.write(block)
+		block = rest[0] + block
+		end = block.rfind(b"\n") + 1
+		rest[0] = block[end:]
+		if end > 0:
+			PARTS.append(Depth_Fields(block[:end]))
+	zipped = gzip.open(Output_file + ".tmp", "wb")
+	try:
+		Run_Command("samtools depth -aa -d0 " + bam, "samtools depth", Parse_Block)
+	except BaseException:
+		zipped.close()
+		os.remove(Output_file + ".tmp")
+		raise
+	zipped.close()
+	if rest[0].strip() != b"":
+		PARTS.append(Depth_Fields(rest[0] + b"\n"))
+	os.replace(Output_file + ".tmp", Output_file)
+	return [Output_file, Depth_Arrays(PARTS, Output_file + ".npz")]
 
 
 def VariantCalling_Medaka(probs, ref, Bam ): 
 	Output_file = probs.split("consensus_probs")[0] + "medaka_variant.vcf"
 	temp = probs.split("consensus_probs")[0] + "temporary.vcf"
 	commands =  "medaka variant --verbose " + ref + " " + probs + " " +  temp
-	os.system(commands)
-	exist_status = os.system(commands)
-	if (exist_status != 0):
-		print('Fail to run medaka variant call commands\n please ensure that the tool is installed and run again the pipeline')
-		exit(0)
+	Run_Command(commands, "medaka variant")
 	commands =  "medaka tools annotate  " + temp + " " + ref + " " + Bam + " " + Output_file
-	os.system(commands)
-	exist_status = os.system(commands)
-	if (exist_status != 0):
-		print('Fail to run annotated tools commands\n please ensure that the tool is installed and run again the pipeline')
-		exit(0)
+	Run_Command(commands, "medaka tools annotate")
 	return Output_file
 
 
 def Add_SampleIDinfo_fasta(fastafile, info, locusList ):
-	newfasta = ""
-	fasta = open (fastafile, "r")
+	# rewrites the headers line by line into a temporary file that replaces the fasta when complete
 	seqN = 0
+	fasta = open (fastafile, "r")
+	New = open(fastafile + ".tmp", "w" )
 	for line in fasta:
 		if line[0] == ">":
-			newfasta = newfasta + "> " +  locusList[seqN] + " " + info + "\n"
+			New.write("> " +  locusList[seqN] + " " + info + "\n")
 			seqN = seqN + 1
 		else:
-			newfasta = newfasta + line	
+			New.write(line)
 	fasta.close()
-	New = open(fastafile, "w" )
-	New.write(newfasta)
 	New.close()
+	os.replace(fastafile + ".tmp", fastafile)
+
+
+VCF_Record = namedtuple("VCF_Record", ["contig", "pos", "ref", "alt", "DP", "FREQ"])
+MUTATION_TYPES = ["SNP", "Insertion", "Deletion", "Other"]
+
+
+def Parse_VCF_Record(line):
+	# medaka annotated VCF line parsed once: frequency from the SR, AR and DPSP INFO fields and DP coverage
+	fields = line.split("\t")
+	info = dict( item.split("=", 1) for item in fields[7].split(";") if "=" in item )
+	SRinfo = info["SR"].split(",")
+	SR = float(SRinfo[2]) + float(SRinfo[3]) 
+	AR = sum([float(AR) for AR in info["AR"].split(",") ])
+	DPSP = float(info["DPSP"])
+	DP = float(info["DP"])
+	if (DPSP - AR) > 0:
+		FREQ = round(SR /(DPSP - AR), 3)
+	else:
+		FREQ = 0
+	return VCF_Record(fields[0], int(fields[1]), fields[3], fields[4], DP, FREQ)
+
+
+def Variant_Set(records):
+	# compact columnar record set of parsed VCF records: NumPy arrays for positions, coverage and frequency,
+	# categorical codes for the locus (index into "contigs") and the mutation type (index into MUTATION_TYPES)
+	contigs = list(dict.fromkeys([ r.contig for r in records ]))
+	code = { contig: i for i, contig in enumerate(contigs) }
+	REF = np.array([ r.ref for r in records ], dtype = object)
+	ALT = np.array([ r.alt for r in records ], dtype = object)
+	lr = np.array([ len(R) for R in REF ], dtype = np.int64)
+	la = np.array([ len(A) for A in ALT ], dtype = np.int64)
+	TYPE = np.full(len(records), 3, dtype = np.int8)
+	TYPE[(la == 1) & (lr == 1)] = 0
+	TYPE[la > lr] = 1
+	TYPE[lr > la] = 2
+	return { "contigs": contigs,
+	         "contig": np.array([ code[r.contig] for r in records ], dtype = np.int32),
+	         "pos": np.array([ r.pos for r in records ], dtype = np.int64),
+	         "ref": REF, "alt": ALT, "type": TYPE,
+	         "DP": np.array([ r.DP for r in records ], dtype = np.float64),
+	         "FREQ": np.array([ r.FREQ for r in records ], dtype = np.float64) }
+
 
 def Get_Variant_INFO_fromVCF(VCFpath):
-	POSITIONS, MUTATIONS, TYPE, SCORES, IDSEQ, COVERAGES = [ ], [ ],[ ] , [ ], [], []
+	# variant record set (see Variant_Set) of an annotated VCF, parsed in a single pass
+	records = []
 	vcf_file = open( VCFpath, "r" )
 	for line in vcf_file:
 		if line[0] != "#":
-			mutType = "Other"
-			A = line.split("\t")[4]
-			R = line.split("\t")[3]
-			SRinfo = line.split("\t")[7].split("SR=")[1].split(";")[0].split(",")
-			ARinfo = line.split("\t")[7].split("AR=")[1].split(";")[0].split(",")
-			SR = float(SRinfo[2]) + float(SRinfo[3]) 
-			AR = sum([float(AR) for AR in ARinfo ])
-			DPSP = float(line.split("\t")[7].split("DPSP=")[1].split(";")[0])
-			DP = float(line.split("\t")[7].split("DP=")[1].split(";")[0])
-			IDseq = line.split("\t")[0] 
-			if (DPSP - AR) > 0:
-				FREQ = round(SR /(DPSP - AR), 3)
-			else:
-				FREQ = 0
-			if len(A) == 1 and len(R) == 1:
-				mutType = "SNP"
-			if len(A) > len(R):
-				mutType = "Insertion"
-			if len(R) > len(A):
-				mutType = "Deletion"
-			POSITIONS.append(line.split("\t")[1])
-			MUTATIONS.append(R + "-->" + A)
-			TYPE.append(mutType)
-			SCORES.append( str(FREQ))
-			IDSEQ.append(IDseq)
-			COVERAGES.append(DP)
+			records.append(Parse_VCF_Record(line))
 	vcf_file.close() 
-	return [POSITIONS, MUTATIONS, SCORES, TYPE, IDSEQ, COVERAGES ]
+	return Variant_Set(records)
 
 
 def Refine_medaka_VCF_with_coverage_and_frequency ( VCFpath, cutoff, BadRegions, MinFreq, INDELmax ): 
-	VCF2, n , id_count, IDj = "", 0, 0, "inicial" 
+	# streams the VCF keeping the variants with enough coverage and frequency, outside bad regions and with
+	# small indels; kept lines go to a temporary file that replaces the VCF when complete
+	# returns the record set of the kept variants, so the refined VCF does not have to be parsed again
+	kept = []
 	VCF_file = open( VCFpath, "r" )
+	VCF_file2 = open( VCFpath + ".tmp", "w" )
 	for line in VCF_file:
 		if line[0] == "#":
-			VCF2 = VCF2 + line 
-		if line[0] != "#": 
-			# position of variant in sequence as a string tag for serching possible tags in bad regions list     			
-			Pi = line.split("\t")[0] + "_" + line.split("\t")[1]  
-			# get coverage and frequency values  
-			IDi = line.split("\t")[0]
-			if IDi != IDj:
-				id_count = id_count + 1
-				IDi = IDj 
-			SRinfo = line.split("\t")[7].split("SR=")[1].split(";")[0].split(",")
-			ARinfo = line.split("\t")[7].split("AR=")[1].split(";")[0].split(",")
-			SR = float(SRinfo[2]) + float(SRinfo[3]) 
-			AR = sum([float(AR) for AR in ARinfo ])
-			DPSP = float(line.split("\t")[7].split("DPSP=")[1].split(";")[0])
-			DP = float(line.split("\t")[7].split("DP=")[1].split(";")[0])
-			seqTag = str(id_count) + "_" + str(DP)
-			if (DPSP - AR) > 0:
-				FREQ = round(SR /(DPSP - AR), 3)
-			else:
-				FREQ = 0
-			# compute the number of bases that are on delected or inserted ( aims removing possible error variants )
-			MLVAR = abs(len(line.split("\t")[4]) - len(line.split("\t")[3]))
-			if DP >= cutoff and seqTag not in BadRegions and FREQ >=MinFreq  and MLVAR <= INDELmax:
-				VCF2 = VCF2 + line 
-			n=n+1		
+			VCF_file2.write(line)
+			continue
+		record = Parse_VCF_Record(line)
+		# compute the number of bases that are on delected or inserted ( aims removing possible error variants )
+		MLVAR = abs(len(record.alt) - len(record.ref))
+		if record.DP >= cutoff and not In_Bad_Regions(BadRegions, record.contig, record.pos) and record.FREQ >= MinFreq and MLVAR <= INDELmax:
+			VCF_file2.write(line)
+			kept.append(record)
 	VCF_file.close()
-	VCF_file2 = open(VCFpath, "w" )
-	VCF_file2.write(VCF2)
 	VCF_file2.close()
+	os.replace(VCFpath + ".tmp", VCFpath)
+	return Variant_Set(kept)
 
 
-def UnecessaryFiles_remove(Gpath, Spath, output_path, TemporarySTATS, Q):
-	os.remove(TemporarySTATS)
-	Extensions = [".mmi", ".fai" ]
-	for extension in Extensions:
-		os.remove(Gpath+extension)
-	if Q > 0:
-		HQfilepath = Spath.split(".")[0] + "_HQ.fastq.gz"
+def UnecessaryFiles_remove(HQfilepath, output_path):
+	if os.path.exists(HQfilepath):
 		os.remove(HQfilepath)
 	files = os.listdir(output_path)
 	for File in files:
 		if File.split(".")[-1] == "depth" or File.split(".")[-1] == "hdf" or File.split(".")[0] == "temporary" or File.split(".")[0] == "allinment" :
 			os.remove(output_path+"/"+File) 
 
-def HQfilterReads(path, Q, H, T, L ):
-	Output_file = path.split(".")[0] + "_HQ.fastq.gz"
-	param = 	"-q " + str(Q) +  " -l " + str(L) +  " --headcrop " + str(H) + " --tailcrop " + str(T)
-	commands =  "gunzip -c " + path + " | NanoFilt " + param +  " | gzip > " + Output_file
+def File_Hash(path):
+	digest = hashlib.sha256()
+	with open(path, "rb") as f:
+		for block in iter(lambda: f.read(1 << 20), b""):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+def Private_Folder(path):
+	# creates a folder only the user can enter (0700), or checks that an existing one is owned by the user and not
+	# writable by others, so no other local user can plant indexes or statistics in it (raises PermissionError)
+	if not os.path.isdir(path):
+		os.makedirs(path, mode = 0o700, exist_ok = True)
+	info = os.stat(path)
+	if info.st_uid != os.getuid() or info.st_mode & 0o022:
+		raise PermissionError("the cache folder " + path + " is not owned by the user or is writable by others, please use --ref_cache with a private folder")
+	return path
+
+
+def Cache_Lock(folder):
+	# exclusive lock of a reference cache folder, held while a run registers in it or releases it (closing frees it)
+	lock = open(folder + ".lock", "a")
+	fcntl.flock(lock, fcntl.LOCK_EX)
+	return lock
+
+
+def Prepare_Reference_Cache(Gpath, cacheRoot, engine = "samtools"):
+	# builds the minimap2 index, the faidx and the parsed reference once, in a cache folder named by the
+	# reference content hash, so all samples (and other runs of the user with the same reference) reuse them
+	# the faidx is made in process with the pysam engine (returns [cache folder, cached reference path, parsed reference])
+	# the cache is checked and the run registered under the cache lock, a concurrent run waits for the build
+	folder = Private_Folder(cacheRoot) + "/" + File_Hash(Gpath)[:24]
+	Cached = folder + "/reference.fasta"
+	lock = Cache_Lock(folder)
+	try:
+		if os.path.isdir(folder):
+			Private_Folder(folder)
+		if not os.path.exists(folder + "/reference.json"):
+			# built aside and renamed into place, an interrupted build leaves no partial cache behind
+			shutil.rmtree(folder, ignore_errors = True)
+			building = folder + ".building." + str(os.getpid())
+			shutil.rmtree(building, ignore_errors = True)
+			os.makedirs(building, mode = 0o700)
+			try:
+				shutil.copyfile(Gpath, building + "/reference.fasta")
+				if engine == "pysam":
+					import pysam
+					try:
+						pysam.faidx(building + "/reference.fasta")
+					except pysam.utils.SamtoolsError as error:
+						raise ToolError("Fail to index the reference with pysam\n" + str(error))
+				else:
+					Run_Command("samtools faidx " + building + "/reference.fasta", "samtools faidx")
+				Run_Command("minimap2 -I 16G -x map-ont -d " + building + "/reference.fasta.mmi " + building + "/reference.fasta", "minimap2 index")
+				with open(building + "/reference.json", "w") as parsed:
+					json.dump(import_seqs(building + "/reference.fasta"), parsed)
+			except BaseException:
+				shutil.rmtree(building, ignore_errors = True)
+				raise
+			os.rename(building, folder)
+		os.makedirs(folder + "/runs", exist_ok = True)
+		open(folder + "/runs/" + str(os.getpid()), "w").close()
+	finally:
+		lock.close()
+	with open(folder + "/reference.json") as parsed:
+		Reference = json.load(parsed)
+	return [folder, Cached, Reference]
+
+
+def Process_Alive(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+
+def Release_Reference_Cache(folder):
+	# unregisters this run and removes the cache once no other live run is using it (under the cache lock, so a run
+	# registering at the same time keeps the cache)
+	runs = folder + "/runs"
+	lock = Cache_Lock(folder)
+	try:
+		if os.path.exists(runs + "/" + str(os.getpid())):
+			os.remove(runs + "/" + str(os.getpid()))
+		for marker in os.listdir(runs):
+			if marker.isdigit() and Process_Alive(int(marker)):
+				return
+		shutil.rmtree(folder, ignore_errors = True)
+	finally:
+		lock.close()
+
+
+MANIFEST_STEPS = ["filter", "medaka", "depth", "variants", "consensus", "report", "finalize"]
+
+
+def Manifest_Path(outputpath):
+	return os.path.dirname(outputpath) + "/RunManifest/" + os.path.basename(outputpath) + ".json"
+
+
+def Load_Manifest(manifestpath, sampleIDname):
+	# run manifest of a sample: completed steps with the parameters they used and the hashes of their outputs
+	if os.path.exists(manifestpath):
+		with open(manifestpath) as f:
+			return json.load(f)
+	return {"sample": sampleIDname, "steps": {}, "reported": False }
+
+
+def Save_Manifest(manifestpath, manifest):
+	os.makedirs(os.path.dirname(manifestpath), exist_ok = True)
+	with open(manifestpath + ".tmp", "w") as f:
+		json.dump(manifest, f)
+	os.replace(manifestpath + ".tmp", manifestpath)
+
+
+def Checkpoint(manifestpath, manifest, step, key, outputs, extra = {}):
+	# records a completed step, the steps after it belong to an older run and are dropped
+	clock = Step_Clock()
+	for later in MANIFEST_STEPS[MANIFEST_STEPS.index(step):]:
+		manifest["steps"].pop(later, None)
+	info = {"key": key, "outputs": { output: File_Hash(output) for output in outputs } }
+	info.update(extra)
+	manifest["steps"][step] = json.loads(json.dumps(info))
+	Save_Manifest(manifestpath, manifest)
+	Record_Step("checkpoint", clock)
+
+
+def Step_Done(manifest, step, key):
+	# a step is done when it ran with the same parameters and its outputs are unchanged since
+	info = manifest["steps"].get(step)
+	if info == None or info["key"] != json.loads(json.dumps(key)):
+		return False
+	for output, digest in info["outputs"].items():
+		if not os.path.exists(output) or File_Hash(output) != digest:
+			return False
+	return True
+
+
+def Resume_Step(manifest, KEYS):
+	# index of the first step to run (the steps after an incomplete one are run again)
+	if Step_Done(manifest, "finalize", KEYS["finalize"]):
+		return len(MANIFEST_STEPS)
+	for i, step in enumerate(MANIFEST_STEPS):
+		if not Step_Done(manifest, step, KEYS[step]):
+			return i
+	return len(MANIFEST_STEPS)
+
+
+def Thread_Budget(jobs):
+	# medaka threads per job, so that threads times jobs stays within the core count
+	cores = os.cpu_count() or 1
+	return max(1, min(8, cores // max(1, jobs)))
+
+
+def Plot_Workers(jobs):
+	# deferred plot processes, on the cores the sample jobs leave free (at least one, at most one per job)
+	cores = os.cpu_count() or 1
+	return max(1, min(jobs, cores - jobs*Thread_Budget(jobs)))
+
+
+QUAL_ERROR = [ 10**(q / -10) for q in range(128) ]
+# base error probability indexed by the fastq quality character (phred + 33)
+ERROR_TABLE = np.array([ 0.0 ]*33 + QUAL_ERROR + [ 0.0 ]*95)
+
+
+def Open_Reads(path):
+	# reads files can be gzip compressed or plain fastq
+	with open(path, "rb") as f:
+		magic = f.read(2)
+	if magic == b"\x1f\x8b":
+		return gzip.open(path, "rb")
+	return open(path, "rb", buffering = 1024*1024)
+
+
+def Read_Quality(qual):
+	# average read quality as NanoFilt and NanoStat compute it (-10 log10 of the mean base error)
+	if len(qual) == 0:
+		return 0
+	return -10 * log(sum([QUAL_ERROR[q - 33] for q in qual]) / len(qual), 10)
+
+
+def Reads_Chunks(path, size = 20000):
+	# yields [headers, sequences, qualities] of up to size fastq records (4 lines records, as nanopore writes them)
+	# the chunk files of a barcode folder are streamed one after the other, without merging them on disk
+	# records cut off by an interrupted write (missing lines, quality shorter than the sequence, truncated gzip)
+	# are skipped with a warning, the complete records of the file are kept
+	headers, seqs, quals = [], [], []
+	for File in Reads_Files(path):
+		reads, skipped = Open_Reads(File), 0
+		try:
+			for header in reads:
+				if header.strip() == b"":
+					continue
+				seq, plus, qual = next(reads, b"").rstrip(), next(reads, b""), next(reads, b"").rstrip()
+				if len(qual) != len(seq) or len(seq) == 0:
+					skipped = skipped + 1
+					continue
+				headers.append(header)
+				seqs.append(seq)
+				quals.append(qual)
+				if len(quals) == size:
+					yield [headers, seqs, quals]
+					headers, seqs, quals = [], [], []
+		except EOFError:
+			print("\n ...warning:", File, "is a truncated gzip file, the reads after its last complete block are skipped")
+		reads.close()
+		if skipped > 0:
+			print("\n ...warning:", skipped, "incomplete fastq records skipped in", File)
+	if len(quals) > 0:
+		yield [headers, seqs, quals]
+
+
+def Segments_Quality(errors, starts, ends):
+	# average quality of the errors[starts[i]:ends[i]] segments, vectorized with a single reduceat
+	lengths = ends - starts
+	index = np.empty(2*len(starts), dtype = np.int64)
+	index[0::2], index[1::2] = starts, ends
+	sums = np.add.reduceat(np.append(errors, 0.0), index)[0::2]
+	quality = np.zeros(len(starts))
+	ok = lengths > 0
+	quality[ok] = -10 * np.log10(sums[ok] / lengths[ok])
+	return quality
+
+
+def Chunk_Qualities(quals):
+	# [read lengths, average read qualities, base errors, read starts] of a chunk of quality strings
+	lengths = np.fromiter(map(len, quals), dtype = np.int64, count = len(quals))
+	errors = ERROR_TABLE[np.frombuffer(b"".join(quals), dtype = np.uint8)]
+	starts = np.cumsum(lengths) - lengths
+	return [lengths, Segments_Quality(errors, starts, starts + lengths), errors, starts]
+
+
+def Summarise_Reads(counts):
+	# counts = [number of reads, sum of lengths, sum of squared lengths, sum of the error of the int read qualities]
+	n, S1, S2, SE = counts
+	if n == 0:
+		return [0.0, 0.0, 0.0, 0, 0.0]
+	STD = sqrt( (n*S2 - S1*S1) / (n*n) )   # population standard deviation, as NanoStat reports
+	# mean read quality as NanoStat (nanomath ave_qual of the read qualities truncated to int): -10 log10 of the mean error
+	return [round(S1/n, 1), round(STD, 1), round(-10 * log(SE/n, 10), 1), n, float(S1)]
+
+
+def Count_Reads(counts, lengths, qualities, quals):
+	# adds a chunk of reads to the counts; quals(i) is the quality string of read i
+	# the read qualities are truncated as NanoStat does it, after nanoget stores them as float32 (reads within
+	# rounding of an integer are taken from the exact NanoStat arithmetic); reads cropped to nothing are left out, as
+	# NanoStat drops them
+	kept = np.flatnonzero(lengths > 0)
+	lengths, qualities = lengths[kept], qualities[kept]
+	for i in np.flatnonzero(np.abs(qualities - np.round(qualities)) < 1e-6):
+		qualities[i] = Read_Quality(quals(kept[i]))
+	floors = np.floor(qualities.astype(np.float32))
+	counts[0] = counts[0] + len(lengths)
+	counts[1] = counts[1] + int(lengths.sum())
+	counts[2] = counts[2] + int((lengths*lengths).sum())
+	counts[3] = counts[3] + float(np.power(10.0, floors / -10).sum())
+
+
+def Reads_Stats(ReadsPath):
+	# [MeanReadLength, ReadLengthSTD, MeanReadQual, NumberReads, TotalBases] of a fastq file or a folder of chunks
+	counts = [0, 0, 0, 0.0]
+	for headers, seqs, quals in Reads_Chunks(ReadsPath):
+		lengths, qualities = Chunk_Qualities(quals)[0:2]
+		Count_Reads(counts, lengths, qualities, lambda i: quals[i])
+	return Summarise_Reads(counts)
+
+
+def HQfilterReads(path, Q, H, T, L, Output_file ):
+	# streaming replacement of  gunzip | NanoFilt -q Q -l L --headcrop H --tailcrop T | gzip  into Output_file
+	# reads pass with average quality > Q and length >= L + H + T, and are written cropped by H and T
+	# the raw and filtered reads statistics are collected in the same pass (returns [HQ file, raw stats, HQ stats])
 	print ("\n ...filtering reads with quality > Q", str(Q), " \n ")
-	os.system(commands)
-	exist_status = os.system(commands)
-	if (exist_status != 0):
-		print('Fail to run NanoFilt tool commands for HQ reads filtering \n please ensure that the tool is installed and run again the pipeline')
-		exit(0)		 
-	return Output_file
+	minlen = L + H + T
+	raw, hq = [0, 0, 0, 0.0], [0, 0, 0, 0.0]
+	output = gzip.open(Output_file, "wb", compresslevel = 1)
+	try:
+		for headers, seqs, quals in Reads_Chunks(path):
+			lengths, qualities, errors, starts = Chunk_Qualities(quals)
+			Count_Reads(raw, lengths, qualities, lambda i: quals[i])
+			# reads too close to the cutoff are decided with the exact NanoFilt arithmetic
+			for i in np.flatnonzero(np.abs(qualities - Q) < 1e-6):
+				qualities[i] = Read_Quality(quals[i])
+			passed = np.flatnonzero((qualities > Q) & (lengths >= minlen))
+			trimmed_starts, trimmed_ends = starts[passed] + H, starts[passed] + lengths[passed] - T
+			Count_Reads(hq, trimmed_ends - trimmed_starts, Segments_Quality(errors, trimmed_starts, trimmed_ends), lambda i: quals[passed[i]][H:lengths[passed[i]]-T])
+			FQ = []
+			for i in passed:
+				n = lengths[i]
+				FQ.append(headers[i] + seqs[i][H:n-T] + b"\n+\n" + quals[i][H:n-T] + b"\n")
+			output.write(b"".join(FQ))
+	except BaseException:
+		# a sample failing while filtering (unreadable reads file) leaves no partial HQ file behind
+		output.close()
+		os.remove(Output_file)
+		raise
+	output.close()
+	return [Output_file, Summarise_Reads(raw), Summarise_Reads(hq)]
 
-def Reads_Stats(ReadsPath, PATH, NAME ):
+
+READS_STATS_VERSION = 2   # bumped when the reads statistics change (2: mean quality as NanoStat, from int read qualities)
+
+
+def Cached_Reads_Stats(cachepath, ReadsPath, FILTER):
+	# [raw stats, HQ stats] saved by a previous run, if the reads (path, files, size, mtime) and the filter are unchanged
+	# the cache only saves time: an unreadable or damaged entry is warned about and the reads are read again
+	if not os.path.exists(cachepath):
+		return None
+	try:
+		with open(cachepath) as f:
+			cache = json.load(f)
+		if cache.get("version") != READS_STATS_VERSION or cache["path"] != os.path.abspath(ReadsPath) or cache.get("signature") != Reads_Signature(ReadsPath) or cache["filter"] != FILTER:
+			return None
+		return [cache["raw"], cache["hq"]]
+	except (OSError, ValueError, KeyError, TypeError) as error:
+		print("\n ...warning: reads statistics cache", cachepath, "not used:", error)
+		return None
+
+
+def Store_Reads_Stats(cachepath, ReadsPath, FILTER, RAW, HQ):
+	# best effort, a cache folder that cannot be written (full, read only) is warned about and the sample goes on
+	cache = {"version": READS_STATS_VERSION, "path": os.path.abspath(ReadsPath), "signature": Reads_Signature(ReadsPath), "filter": FILTER, "raw": RAW, "hq": HQ }
+	try:
+		os.makedirs(os.path.dirname(cachepath), exist_ok = True)
+		with open(cachepath + "." + str(os.getpid()), "w") as f:
+			json.dump(cache, f)
+		os.replace(cachepath + "." + str(os.getpid()), cachepath)
+	except OSError as error:
+		print("\n ...warning: reads statistics not saved in the cache:", error)
+		try:
+			os.remove(cachepath + "." + str(os.getpid()))
+		except OSError:
+			pass
+
+
+def Prune_Reads_Stats(cacheRoot):
+	# removes the reads statistics of reads that no longer exist, damaged entries and the partial files of dead runs
+	folder = cacheRoot + "/reads_stats"
+	if not os.path.isdir(folder):
+		return
+	for name in os.listdir(folder):
+		entry = folder + "/" + name
+		try:
+			if not name.endswith(".json"):
+				pid = name.rsplit(".", 1)[-1]
+				if not pid.isdigit() or not Process_Alive(int(pid)):
+					os.remove(entry)
+				continue
+			try:
+				with open(entry) as f:
+					path = json.load(f)["path"]
+			except (ValueError, KeyError, TypeError):
+				path = None
+			if path == None or not os.path.exists(path):
+				os.remove(entry)
+		except OSError as error:
+			print("\n ...warning: reads statistics cache entry", entry, "not pruned:", error)
+
+
+def Reads_Stats_Path(cacheRoot, ReadsPath, FILTER):
+	# stats cache file of a reads file and filter, in the cache folder shared by all runs (any run name)
+	return cacheRoot + "/reads_stats/" + hashlib.sha256((os.path.abspath(ReadsPath) + json.dumps(FILTER)).encode()).hexdigest()[:24] + ".json"
+
+
+def Write_Reads_Stats(STATS, PATH, NAME ):
+	# NanoStat like tsv report of the reads statistics
 	Output_file =  PATH + "/" + NAME + ".txt"
-	commands =  "NanoStat --fastq "  + ReadsPath +  "  --tsv > " + Output_file
-	os.system(commands)
-	exist_status = os.system(commands)
-	if (exist_status != 0):
-		print('Fail to run NanoStats tool commands\n please ensure that the tool is installed and run again the pipeline')
-		exit(0)
-	MeanReadLength, ReadLengthSTD, MeanReadQual, NumberReads, TotalBases =  "", "", "", "", ""   
-	SF = open(Output_file)
-	for line in SF:
-		S = line.split("\t")
-		if S[0] == "mean_read_length":
-			MeanReadLength=S[1]
-		if S[0] == "read_length_stdev":
-			ReadLengthSTD=S[1]
-		if S[0] == "mean_qual":
-			MeanReadQual=S[1]
-		if S[0] == "number_of_reads":
-			NumberReads=S[1]
-		if S[0] == "number_of_bases":
-			TotalBases=S[1]
+	SF = open(Output_file, "w")
+	SF.write("Metrics\tdataset\n")
+	for metric, value in zip(["mean_read_length", "read_length_stdev", "mean_qual", "number_of_reads", "number_of_bases"], STATS):
+		SF.write(metric + "\t" + str(value) + "\n")
 	SF.close()
-	return [MeanReadLength, ReadLengthSTD, MeanReadQual, NumberReads, TotalBases]
+	return Output_file
+
+
+NUC_TO_UPPER = bytes.maketrans(b"acgt", b"ACGT")
+
+
+def Read_Fasta(fasta_file):
+	# yields [seqid, sequence] records lazily, with a, c, g and t upper cased by a bulk translation
+	# (seqid is the first word of the header, as in Biopython)
+	seqid, lines = None, []
+	fasta = open(fasta_file, "rb")
+	for line in fasta:
+		if line[:1] == b">":
+			if seqid != None:
+				yield [seqid, b"".join(lines).translate(NUC_TO_UPPER, b" \r\n").decode()]
+			title = line[1:].split()
+			seqid, lines = (title[0].decode() if len(title) > 0 else ""), []
+		elif seqid != None:
+			lines.append(line)
+	fasta.close()
+	if seqid != None:
+		yield [seqid, b"".join(lines).translate(NUC_TO_UPPER, b" \r\n").decode()]
+
+
+def Fasta_IDs(fasta_file):
+	# sequence IDs of a fasta file, read from the headers only (same rule as Read_Fasta)
+	IDs = []
+	with open(fasta_file, "rb") as fasta:
+		for line in fasta:
+			if line[:1] == b">":
+				title = line[1:].split()
+				IDs.append(title[0].decode() if len(title) > 0 else "")
+	return IDs
 
 
 def import_seqs(fasta_file):
-	seqs = []
-	nuc_to_NUC = {"a": "A","c":"C", "t":"T", "g":"G"}  
-	for record in SeqIO.parse(fasta_file, 'fasta'):
-		seqid = record.id
-		sequence = str(record.seq)
-		sequence_new = ""
-		for nuc in sequence:
-			if nuc in ["a", "c", "t", "g" ]:
-				sequence_new = sequence_new + str(nuc_to_NUC.get(nuc)) 
-			else:
-				sequence_new = sequence_new + str(nuc)
-
-		seqs.append([seqid, sequence_new])	 
-	return seqs
-
-
-def LowCov_SeqMasker(AlignSequences, depthFilePath , output_fasta, cutoff, Bad_regions) :
-	seqHeader, n, depths, Ncount, missmatch = [], 0, [], 0, 0
-	Depth_File = open(depthFilePath, "r") 
-	for line in Depth_File:
-		n= n+1
-		info = line.split("\t")
-		value = int(float(info[2]))
-		if info[0] not in seqHeader:
-			seqHeader.append(info[0]) 
-			if n !=1:
-				depths.append(values)
-			values = [ value ]
-		else:
-			values.append(value)
-	depths.append(values)
-	Depth_File.close() 
-	RefSeq, SampleSeq, SeqID = [], [], [] 
+	return list(Read_Fasta(fasta_file))
+
+
+def Depth_Fields(data):
+	# [IDs, positions, depths] arrays of complete samtools depth lines
+	fields = data.replace(b"\n", b"\t").split(b"\t")
+	n = len(fields) // 3
+	IDs = np.array(fields[0:3*n:3])
+	pos = np.array(fields[1:3*n:3]).astype(np.float64).astype(np.int32)
+	depth = np.array(fields[2:3*n:3]).astype(np.float64).astype(np.int32)
+	return [IDs, pos, depth]
+
+
+def Save_Depth_Cache(cachePath, DEPTH):
+	np.savez(cachePath, contigs = np.array(DEPTH["contigs"]), bounds = np.cumsum([0] + [ len(p) for p in DEPTH["pos"] ]).astype(np.int64),
+	         pos = np.concatenate(DEPTH["pos"] + [ np.array([], dtype = np.int32) ]), depth = np.concatenate(DEPTH["depth"] + [ np.array([], dtype = np.int32) ]))
+
+
+def Depth_Arrays(PARTS, cachePath):
+	# joins the [IDs, positions, depths] parts into per contig arrays {"contigs", "pos", "depth"} and caches them in cachePath
+	IDs = np.concatenate([ part[0] for part in PARTS ]) if len(PARTS) > 0 else np.array([], dtype = bytes)
+	pos = np.concatenate([ part[1] for part in PARTS ] + [ np.array([], dtype = np.int32) ])
+	depth = np.concatenate([ part[2] for part in PARTS ] + [ np.array([], dtype = np.int32) ])
+	bounds = np.concatenate([ [0], np.flatnonzero(IDs[1:] != IDs[:-1]) + 1, [len(IDs)] ]).astype(np.int64)
+	contigs = [ IDs[b].decode() for b in bounds[:-1] ]
+	DEPTH = { "contigs": contigs,
+	          "pos": [ pos[bounds[i]:bounds[i+1]] for i in range(len(bounds) - 1) ],
+	          "depth": [ depth[bounds[i]:bounds[i+1]] for i in range(len(bounds) - 1) ] }
+	Save_Depth_Cache(cachePath, DEPTH)
+	return DEPTH
+
+
+def Load_Depth(depthFilePath):
+	# samtools depth output (plain or gzipped) as per contig NumPy int32 arrays {"contigs", "pos", "depth"}, in file order
+	# the arrays are cached in a .npz next to the depth file and reused while the cache is up to date
+	cachePath = depthFilePath + ".npz"
+	if os.path.exists(cachePath) and (not os.path.exists(depthFilePath) or os.path.getmtime(cachePath) >= os.path.getmtime(depthFilePath)):
+		cache = np.load(cachePath)
+		bounds = cache["bounds"]
+		return { "contigs": [ str(c) for c in cache["contigs"] ],
+		         "pos": [ cache["pos"][bounds[i]:bounds[i+1]] for i in range(len(bounds) - 1) ],
+		         "depth": [ cache["depth"][bounds[i]:bounds[i+1]] for i in range(len(bounds) - 1) ] }
+	with (gzip.open(depthFilePath, "rb") if depthFilePath.endswith(".gz") else open(depthFilePath, "rb")) as f:
+		data = f.read()
+	return Depth_Arrays([ Depth_Fields(data) ], cachePath)
+
+
+def LowCov_SeqMasker(AlignSequences, DEPTH , output_fasta, cutoff, Bad_regions) :
+	# masks with N the sample bases of the reference/sample alignments with coverage below the cutoff or in bad regions
+	# alignment columns are mapped to reference coordinates with a cumulative sum over the reference bases
+	# the depth of each alignment is found by the segment ID of its "Reference ID" header (by position without one)
+	GAP, NULL = ord("-"), 0
+	Ncount, missmatch, SeqLenght = 0, 0, 0 
+	RefSeq, SampleSeq, SeqID, RefID = [], [], [], [] 
+	CONTIGS = { contig: i for i, contig in enumerate(DEPTH["contigs"]) }
 	for seq in AlignSequences:
 		if seq[0].find("Reference") > -1:
 			RefSeq.append(seq[1])
+			RefID.append(seq[0].split(" ", 1)[1] if " " in seq[0] else DEPTH["contigs"][len(RefID)])
 		if seq[0].find("Sample") > -1:
 			SampleSeq.append(seq[1])
 			SeqID.append(seq[0])
 	sequences_masked = [ ]
-	SeqLenght = 0 
 	for i, seq in enumerate(RefSeq):
-		seq2 = ""
-		k = 0 
-		for j, rB in enumerate(seq):
-			icov = float(depths[i][k])
-			sB =""
-			if j < len (SampleSeq[i]):
-				sB = SampleSeq[i][j]   
-			if rB != "-":
-				if k < len(depths[i]) -1 :    
-					k = k + 1
-				if sB != "-":
-					SeqLenght = SeqLenght+1
-					if icov < cutoff or SeqLenght in Bad_regions:
-						sB = "N"
-						Ncount = Ncount+1
-					seq2 = seq2 + sB
-			if rB == "-" and sB != "-":
-				SeqLenght = SeqLenght + 1
-				if SeqLenght in Bad_regions and icov < cutoff:
-					sB = "N"
-					Ncount = Ncount+1
-				seq2 = seq2 + sB
-				missmatch = missmatch + 1
-			if rB != "-" and sB == "-":
-				 missmatch = missmatch + 1
-		seq2 = seq2.replace("\n", "" )  
+		ref = np.frombuffer(seq.encode(), dtype = np.uint8)
+		# sample columns beyond the sample alignment length are empty (NULL)
+		sample = np.zeros(len(ref), dtype = np.uint8)
+		sampleBytes = np.frombuffer(SampleSeq[i].encode(), dtype = np.uint8)[:len(ref)]
+		sample[:len(sampleBytes)] = sampleBytes
+		refBase, sampleGap = ref != GAP, sample == GAP
+		# depth of each column: reference bases take their own depth, insertions the depth of the next reference base
+		# a segment without depth (not in the alignments) is all low coverage
+		depth = DEPTH["depth"][CONTIGS[RefID[i]]] if RefID[i] in CONTIGS else np.zeros(1, dtype = np.int32)
+		refPosition = np.cumsum(refBase) - refBase
+		lowCov = depth[np.minimum(refPosition, len(depth) - 1)] < cutoff
+		bad = Bad_Regions_Mask(Bad_regions, RefID[i], refPosition + 1)
+		counted = ~sampleGap
+		masked = counted & ((refBase & lowCov) | bad)
+		Ncount = Ncount + int(np.count_nonzero(masked))
+		missmatch = missmatch + int(np.count_nonzero(refBase != counted))
+		SeqLenght = SeqLenght + int(np.count_nonzero(counted))
+		seq2 = np.where(masked, ord("N"), sample)[counted]
+		seq2 = seq2[seq2 != NULL].tobytes().decode().replace("\n", "" )  
 		sequences_masked.append(seq2)
 	File2 = open(output_fasta, 'w')
 	for i, seq in enumerate(sequences_masked):
@@ -345,120 +1068,195 @@ def LowCov_SeqMasker(AlignSequences, depthFilePath , output_fasta, cutoff, Bad_r
 
 
 
-plt.style.use("ggplot")
-plt.rcParams["figure.figsize"] = (20,10)
-def CoverageQuality_Plot(tsh1, tsh2, DepthFilePath, mutationalINFO):
-	Coverages_ALL, CoverageSeqs, PositionSeqs, IDSEQ, maxLen = [] ,[] ,[] ,[] , 0 
-	F = open(DepthFilePath)
-	for line in F:
-		ID = line.split("\t")[0]
-		C = int(float(line.split("\t")[2]))
-		P = int(float(line.split("\t")[1]))
-		if P > maxLen:
-			maxLen = P 
-		Coverages_ALL.append(C)
-		if ID not in IDSEQ:
-			if len(IDSEQ) != 0:
-				CoverageSeqs.append(COVsi)
-				PositionSeqs.append(POSsi)
-			COVsi = [C]
-			POSsi = [P] 
-			IDSEQ.append(ID)
-		else:	
-			COVsi.append(C)
-			POSsi.append(P)
-	CoverageSeqs.append(COVsi)
-	PositionSeqs.append(POSsi)
-	F.close()
-	variant_positions, variant_coverages, ids_variants = [], [] ,[] 
-	for i, pos in enumerate(mutationalINFO[0]):
-		if mutationalINFO[4][i] not in ids_variants:
-			if len(ids_variants) != 0:
-				variant_coverages.append(COVsi)
-				variant_positions.append(POSsi)
-			COVsi = [ mutationalINFO[5][i] ]
-			POSsi = [pos] 
-			ids_variants.append(mutationalINFO[4][i])
-		else:	
-			COVsi.append(mutationalINFO[5][i])
-			POSsi.append(pos)
-	variant_coverages.append(COVsi)
-	variant_positions.append(POSsi)
-	seq = [ i for i in range(1, maxLen) ] 
-	plt.clf()
-	plt.style.use("ggplot")
-	plt.rcParams["figure.figsize"] = (20,10)
-	plt.xlabel('Sequence position (bp)', size = 20)
-	plt.ylabel(" Coverage ", size = 20)
-	plt.tick_params(axis = "both", labelsize = 18)
-	plt.title(" Coverage accross the sequence ", size =20)
-	plt.yscale('log')
-	plt.scatter( [], [], color = "green", label = "HQ",  s = 40   ) 
-	plt.scatter( [], [] , color = "yellow", label = "OK Q",  s = 40   ) 
-	plt.scatter( [] , [], color = "red", label = "LQ",  s = 60   )
-	plt.plot( seq, [tsh2 for i in range(1, maxLen) ] , "g--", label = "HQ cutoff", linewidth = 3   )
-	plt.plot( seq , [tsh1 for i in range(1, maxLen) ] , "r--", label = "LQ cutoff", linewidth = 3   )
-	plt.plot( seq , [np.mean(Coverages_ALL) for i in range(1, maxLen) ], "k--", label = "Average coverage", linewidth = 3   ) 
-	plt.scatter( [  ], [], label = "Variants " , color = "blue" ,  s = 200, marker = "+"  ) 
-	for k in range(len(IDSEQ)):
-		seq1, cov1 , seq2, cov2 ,seq3, cov3  = [],[],[],[],[],[]
-		for i, cov in enumerate(CoverageSeqs[k]):
-			if  cov <= tsh1:
-				seq1.append( PositionSeqs[k][i])
-				cov1.append(cov)
-			if cov > tsh1 and cov < tsh2:
-				seq2.append( PositionSeqs[k][i])
-				cov2.append(cov)
-			if cov >= tsh2:
-				seq3.append(PositionSeqs[k][i])
-				cov3.append(cov)
-		plt.scatter( seq3, cov3, color = "green",  s = 40   ) 
-		plt.scatter( seq2, cov2 , color = "yellow",  s = 40   ) 
-		plt.scatter( seq1 , cov1, color = "red",  s = 60   )
-	for k in range(len(variant_positions)):
-		plt.scatter( [ float(P) for P in variant_positions[k] ], [float(C) for C in variant_coverages[k]], color = "blue"  ,  s = 200, marker = "+"  ) 
-	plt.axis([0, maxLen, 0 , max(Coverages_ALL)*10 ])
-	plt.legend(fontsize =18, loc = 'upper right', ncol=7 )
-	PathToSave = DepthFilePath.split("reads")[0] 
-	plt.savefig( PathToSave  + "coverageQualityPlot" )
+PLOT_SIZE, PLOT_DPI = (20, 10), 100
+
+
+def Coverage_Bins(positions, depth, binsize):
+	# [bin positions, min, max] of the coverage in consecutive bins of binsize bases (vectorized with reduceat)
+	bins = (positions - 1) // binsize
+	starts = np.concatenate([ [0], np.flatnonzero(bins[1:] != bins[:-1]) + 1 ]) if len(bins) > 0 else np.zeros(0, dtype = np.int64)
+	return [ positions[starts], np.minimum.reduceat(depth, starts), np.maximum.reduceat(depth, starts) ]
+
+
+def CoverageQuality_Plot(tsh1, tsh2, DEPTH, VARIANTS, PathToSave):
+	# coverage of each locus drawn as a min-max envelope over bins of about one pixel, the parts of the envelope
+	# in the LQ, OK and HQ bands are filled in red, yellow and green
+	Coverages_ALL = np.concatenate(DEPTH["depth"])
+	maxLen = int(np.concatenate(DEPTH["pos"]).max())
+	top = max(int(Coverages_ALL.max()), 1)*10
+	binsize = max(1, -(-maxLen // (PLOT_SIZE[0]*PLOT_DPI)))
+	BANDS = [ ["LQ", "red", 0.5, tsh1], ["OK Q", "yellow", tsh1, tsh2], ["HQ", "green", tsh2, top] ]
+	# matplotlib is only imported when a plot is drawn; the figure is drawn on its own Agg canvas, without pyplot,
+	# so the backend and the figures of a process importing the tool are left alone
+	from matplotlib import style
+	from matplotlib.figure import Figure
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+	with style.context("ggplot"):
+		fig = Figure(figsize = PLOT_SIZE, dpi = PLOT_DPI)
+		FigureCanvasAgg(fig)
+		ax = fig.add_subplot(1, 1, 1)
+		ax.set_xlabel('Sequence position (bp)', size = 20)
+		ax.set_ylabel(" Coverage ", size = 20)
+		ax.tick_params(axis = "both", labelsize = 18)
+		ax.set_title(" Coverage accross the sequence ", size =20)
+		ax.set_yscale('log')
+		for label, color, low, high in BANDS[::-1]:
+			ax.fill_between( [], [], [], color = color, label = label )
+		for positions, depth in zip(DEPTH["pos"], DEPTH["depth"]):
+			x, low_cov, high_cov = Coverage_Bins(positions, np.maximum(depth, 0.5), binsize)
+			for label, color, low, high in BANDS:
+				inside = (high_cov >= low) & (low_cov <= high)
+				ax.fill_between( x, np.clip(low_cov, low, high), np.clip(high_cov, low, high), where = inside, color = color, edgecolor = color, linewidth = 1, step = "post" )
+		ax.plot( [1, maxLen], [tsh2, tsh2], "g--", label = "HQ cutoff", linewidth = 3 )
+		ax.plot( [1, maxLen], [tsh1, tsh1], "r--", label = "LQ cutoff", linewidth = 3 )
+		ax.plot( [1, maxLen], [np.mean(Coverages_ALL)]*2, "k--", label = "Average coverage", linewidth = 3 )
+		ax.scatter( VARIANTS["pos"], VARIANTS["DP"], label = "Variants ", color = "blue", s = 200, marker = "+" )
+		ax.axis([0, maxLen, 0.5, top])
+		ax.legend(fontsize =18, loc = 'upper right', ncol=7 )
+		fig.savefig( PathToSave  + "coverageQualityPlot" )
 	return Coverages_ALL
 
 
-def Run_Alingment_MAFFT(RefSeq, ConsenSeq, path ): 
-	ipath = path + "/temporary.fasta"
+PLOT_DATA = "coverage_plot_data.npz"
+
+
+def Save_Plot_Data(path, tsh1, tsh2, DEPTH, VARIANTS, flagged):
+	# compact arrays needed to draw the coverage plot of a sample later (deferred plots)
+	np.savez_compressed(path, contigs = np.array(DEPTH["contigs"]), bounds = np.cumsum([0] + [ len(p) for p in DEPTH["pos"] ]),
+	                    pos = np.concatenate(DEPTH["pos"]), depth = np.concatenate(DEPTH["depth"]),
+	                    variant_pos = VARIANTS["pos"], variant_DP = VARIANTS["DP"], cutoffs = np.array([tsh1, tsh2]), flagged = np.array(flagged))
+
+
+def Render_Plot_Data(path):
+	# draws the coverage plot of saved plot data in the same folder, returns its timing row
+	clock = Step_Clock()
+	data = np.load(path)
+	bounds = data["bounds"]
+	DEPTH = { "contigs": [ str(c) for c in data["contigs"] ],
+	          "pos": [ data["pos"][bounds[i]:bounds[i+1]] for i in range(len(bounds) - 1) ],
+	          "depth": [ data["depth"][bounds[i]:bounds[i+1]] for i in range(len(bounds) - 1) ] }
+	VARIANTS = { "pos": data["variant_pos"], "DP": data["variant_DP"] }
+	CoverageQuality_Plot( data["cutoffs"][0], data["cutoffs"][1], DEPTH, VARIANTS, os.path.dirname(path) + "/" )
+	return Record_Step("deferred plot", clock)
+
+
+def Run_Alingment_MAFFT(RefSeq, ConsenSeq, path, name = "" ): 
+	# name keeps the temporary files of each segment apart when segments are aligned at the same time
+	ipath = path + "/temporary" + name + ".fasta"
 	ifile = open(ipath, "w")
 	ifile.write(">Reference " + RefSeq[0]+ "\n")
 	ifile.write(RefSeq[1]+ "\n") 
 	ifile.write(">Sample " + ConsenSeq[0]+ "\n")
 	ifile.write(ConsenSeq[1]+ "\n")
 	ifile.close()
-	output = path + "/allinment.fasta"
+	output = path + "/allinment" + name + ".fasta"
 	commands =  "mafft --auto " + ipath + " > " + output 
-	os.system(commands)
-	exist_status = os.system(commands)
-	if (exist_status != 0):
-		print('Fail to run mafft tool commands for allinment fasta file generation...\n please ensure that the tool is installed and run again the pipeline')
-		exit(0)
+	Run_Command(commands, "mafft")
 	return output
 
 
-def Generate_Bad_regions_index ( intervals ):  
-	IndexRemove = []
-	if intervals.find("-") > 0  and intervals.find("1:"): 
-		A = intervals.split(";")
-		for region in A:
-			interval = region.split(":")[1]
-			Iid = region.split(":")[0]  
-			vi = int(float(interval.split("-")[0]))
-			vf = int(float(interval.split("-")[1]))
-			AA = [ Iid + "_" +str(i) for i in range(vi,vf+1) ]
-			for j in AA:
-				if j not in IndexRemove:
-					IndexRemove.append(j)
+def Segment_Alignments_MAFFT(PAIRS, path, threads = 1):
+	# mafft alignments of the [reference segment, consensus segment] pairs, run at the same time (up to threads) with
+	# private temporary files per segment; returns {segment ID: [["Reference ID", seq], ["Sample ID", seq]]}
+	def Align(k):
+		RefSeq, ConsenSeq = PAIRS[k]
+		Allign = import_seqs(Run_Alingment_MAFFT(RefSeq, ConsenSeq, path, "." + str(k)))
+		return [ ["Reference " + RefSeq[0], Allign[0][1]], ["Sample " + RefSeq[0], Allign[1][1]] ]
+	if len(PAIRS) < 2 or threads < 2:
+		ALIGNMENTS = [ Align(k) for k in range(len(PAIRS)) ]
+	else:
+		with ThreadPoolExecutor(max_workers = min(threads, len(PAIRS))) as executor:
+			ALIGNMENTS = list(executor.map(Align, range(len(PAIRS))))
+	return { RefSeq[0]: Allign for (RefSeq, ConsenSeq), Allign in zip(PAIRS, ALIGNMENTS) }
+
+
+def Alignment_From_Variants(RefSeq, ConsenSeq, VARIANTS):
+	# reference/consensus alignment rebuilt from the variants applied by bcftools consensus (chain like liftover),
+	# in the same form as the mafft alignment; None when the rebuilt consensus differs from the consensus sequence
+	ref, A, B, last = RefSeq[1], [], [], 0
+	if RefSeq[0] in VARIANTS["contigs"]:
+		selected = np.flatnonzero(VARIANTS["contig"] == VARIANTS["contigs"].index(RefSeq[0]))
+		for i in selected[np.argsort(VARIANTS["pos"][selected], kind = "stable")]:
+			p, R, ALT = int(VARIANTS["pos"][i]) - 1, VARIANTS["ref"][i].upper(), VARIANTS["alt"][i].upper()
+			if p < last:
+				continue    # overlapping variants are skipped by bcftools consensus
+			A.append(ref[last:p])
+			B.append(ref[last:p])
+			common = min(len(R), len(ALT))
+			A.append(ref[p:p+common])
+			B.append(ALT[:common])
+			if len(R) > len(ALT):
+				A.append(ref[p+common:p+len(R)])
+				B.append("-"*(len(R) - common))
+			else:
+				A.append("-"*(len(ALT) - common))
+				B.append(ALT[common:])
+			last = p + len(R)
+	A.append(ref[last:])
+	B.append(ref[last:])
+	sample = "".join(B)
+	if sample.replace("-", "") != ConsenSeq[1]:
+		return None
+	return [ ["Reference " + RefSeq[0], "".join(A)], ["Sample " + RefSeq[0], sample] ]
+
+
+def Generate_Bad_regions_index ( intervals, contigs ):  
+	# ignore regions as sorted and merged 1-based inclusive intervals per reference sequence: {name: [starts, ends]}
+	# intervals is "none", a BED file or the inline syntax  locus:start-end;...  where locus is the number of
+	# the sequence in the reference (contigs list) or its name; raises ValueError for malformed regions
+	regions = {}
+	if intervals == "none" or intervals.strip() == "":
+		return regions
+	if os.path.isfile(intervals):
+		BED = open(intervals, "r")
+		for line in BED:
+			if line.strip() == "" or line[0] == "#" or line.startswith(("track", "browser")):
+				continue
+			info = line.split()
+			regions.setdefault(info[0], []).append( [int(info[1]) + 1, int(info[2])] )
+		BED.close()
+	else:
+		for region in intervals.split(";"):
+			if region.strip() == "":
+				continue
+			Iid, interval = region.strip().rsplit(":", 1)
+			vi, vf = [ int(float(v)) for v in interval.split("-") ]
+			if Iid not in contigs:
+				if not Iid.isdigit() or not 1 <= int(Iid) <= len(contigs):
+					raise ValueError("unknown locus " + Iid + " in ignore region " + region)
+				Iid = contigs[int(Iid) - 1]
+			regions.setdefault(Iid, []).append( [min(vi, vf), max(vi, vf)] )
+	IndexRemove = {}
+	for Iid, intervalList in regions.items():
+		starts, ends = [], []
+		for vi, vf in sorted(intervalList):
+			if len(ends) > 0 and vi <= ends[-1] + 1:
+				ends[-1] = max(ends[-1], vf)
+			else:
+				starts.append(vi)
+				ends.append(vf)
+		IndexRemove[Iid] = [starts, ends]
 	return IndexRemove       
 
 
-def WriteParametersReport ( path, Refpath, model, coverage_cutoff, minQReads, icut, fcut, cutRegions, analysisName, Ntotal, avTime, date  ):
+def In_Bad_Regions(BadRegions, contig, pos):
+	if contig not in BadRegions:
+		return False
+	starts, ends = BadRegions[contig]
+	i = bisect_right(starts, pos) - 1
+	return i >= 0 and pos <= ends[i]
+
+
+def Bad_Regions_Mask(BadRegions, contig, positions):
+	# In_Bad_Regions for an array of positions
+	if contig not in BadRegions:
+		return np.zeros(len(positions), dtype = bool)
+	starts, ends = np.array(BadRegions[contig][0]), np.array(BadRegions[contig][1])
+	i = np.searchsorted(starts, positions, side = "right") - 1
+	return (i >= 0) & (positions <= ends[np.maximum(i, 0)])
+
+
+def WriteParametersReport ( path, Refpath, model, coverage_cutoff, minQReads, icut, fcut, cutRegions, analysisName, Ntotal, Nrun, totalTime, date  ):
     refname ="unknow reference"
     f1 = open(Refpath, "r" )
     for line in f1:
@@ -479,42 +1277,187 @@ def WriteParametersReport ( path, Refpath, model, coverage_cutoff, minQReads, ic
     f2.write ( "\n   Base trimmning tail crop on reads       " +  str(fcut)   + "\n")
     f2.write ( "\n   Other masking intervals                 " +  cutRegions   +  "\n")
     f2.write ( "\n   Number of files processed               " + str(Ntotal)   + "\n")
-    f2.write ( "\n   Total processing time                   " +  str(round(avTime/60*Ntotal , 1 )) + " min  \n")
-    f2.write ( "\n   Average processing time per sample      " + str(round(avTime/60 , 1 )) + " min \n")
+    f2.write ( "\n   Number of samples processed in this run " + str(Nrun)   + "\n")
+    f2.write ( "\n   Total processing time                   " +  str(round(totalTime/60 , 1 )) + " min  \n")
+    f2.write ( "\n   Average processing time per sample      " + str(round(totalTime/max(Nrun, 1)/60 , 1 )) + " min \n")
     f2.write ("\n===============================================================================================================================\n")
     f2.close()
 
 
+def Write_Timings(path, sampleIDname, timings):
+	# appends the step and command timings of a sample to the run timings.tsv
+	new = not os.path.exists(path + "/timings.tsv")
+	f = open(path + "/timings.tsv", "a")
+	if new:
+		f.write("\t".join(TIMING_FIELDS) + "\n")
+	for row in timings:
+		f.write(sampleIDname + "\t" + "\t".join([ "" if value == None else str(value) for value in row ]) + "\n")
+	f.close()
+
+
+def Timings_Summary(ROWS):
+	# {name: [kind, count, wall s, cpu s, max peak rss MB]} over the timing rows of all samples (None without peak RSS)
+	summary = {}
+	for row in ROWS:
+		item = summary.setdefault(row[1], [row[2], 0, 0.0, 0.0, None])
+		item[1], item[2], item[3] = item[1] + 1, item[2] + row[3], item[3] + row[4]
+		if row[5] != None:
+			item[4] = row[5] if item[4] == None else max(item[4], row[5])
+	return summary
+
+
+def Write_Timings_JSON(path, ROWS, totalTime):
+	summary = Timings_Summary(ROWS)
+	f = open(path + "/timings.json", "w")
+	json.dump({ "total_wall_s": round(totalTime, 3),
+	            "records": [ dict(zip(TIMING_FIELDS, row)) for row in ROWS ],
+	            "summary": { name: dict(zip(["kind", "count", "wall_s", "cpu_s", "peak_rss_mb"], [ item[0], item[1], round(item[2], 3), round(item[3], 3), item[4] ])) for name, item in summary.items() } }, f, indent = 1)
+	f.close()
+
+
+# columns of the run reports after the metadata columns, as [name, type] (names as in the csv headers)
+REPORT_COLUMNS = [ ["Mean Read Quality", float], ["Mean Reads Size", float], ["Total Number Reads", int], ["Total Number Bases", float],
+                   ["Average Coverage", int], ["Consensus sequence coverage", float], ["Number Masked Bases", int], ["Detected mutations", int],
+                   ["Number Insertions", int], ["Number Deletions", int], ["Sequence gaps", int], [" Mean Read Quality After Filter", float],
+                   ["Mean Reads Size After Filter", float], ["Number Reads After Filter", int], ["Number Bases After Filter", float], ["Sample Status", str] ]
+MUTATION_COLUMNS = [ ["Sample Number", int], ["Sample ID", str], ["Mutation", str], ["Type", str], ["Locus", str], ["Position", int],
+                     ["Frequency", float], ["Coverage", int] ]
+COLUMNAR_FORMATS = { "parquet": ".parquet", "arrow": ".arrow" }
+
+
+def Typed_Row(COLUMNS, values):
+	# values of a report row converted to the types of its columns, raises ValueError for a row not matching the schema
+	if len(values) != len(COLUMNS):
+		raise ValueError("report row with " + str(len(values)) + " values for " + str(len(COLUMNS)) + " columns")
+	return [ kind(value) for (name, kind), value in zip(COLUMNS, values) ]
+
+
+def Open_Report(path, COLUMNS):
+	# report csv opened for appending (header written when new), rows are quoted by the csv writer when needed
+	# returns {"path", "file", "writer", "columns"}
+	new = not os.path.exists(path) or os.path.getsize(path) == 0
+	f = open(path, "a", newline = "")
+	writer = csv.writer(f, lineterminator = "\n")
+	if new:
+		writer.writerow([ name for name, kind in COLUMNS ])
+	return { "path": path, "file": f, "writer": writer, "columns": COLUMNS }
+
+
+def Write_Report_Rows(report, rows):
+	report["writer"].writerows([ Typed_Row(report["columns"], row) for row in rows ])
+
+
+def Sync_Reports(REPORTS):
+	# sample boundary: the rows written so far are flushed and synced to disk, a crash loses no reported sample
+	for report in REPORTS:
+		report["file"].flush()
+		os.fsync(report["file"].fileno())
+
+
+def Close_Reports(REPORTS):
+	Sync_Reports(REPORTS)
+	for report in REPORTS:
+		report["file"].close()
+
+
+def Write_Columnar(folder, sampleIDname, COLUMNS, rows, fmt):
+	# rows of one sample as a typed columnar file (parquet or arrow IPC) <folder>/<sample ID>.<fmt>, written aside
+	# and renamed, so the folder can be read as a dataset (e.g. pyarrow.dataset) across samples and runs
+	import pyarrow as pa
+	TYPES = { int: pa.int64(), float: pa.float64(), str: pa.string() }
+	schema = pa.schema([ pa.field(name.strip(), TYPES[kind]) for name, kind in COLUMNS ])
+	rows = [ Typed_Row(COLUMNS, row) for row in rows ]
+	table = pa.Table.from_arrays([ pa.array([ row[i] for row in rows ], type = schema.field(i).type) for i in range(len(COLUMNS)) ], schema = schema)
+	os.makedirs(folder, exist_ok = True)
+	output = folder + "/" + sampleIDname + COLUMNAR_FORMATS[fmt]
+	if fmt == "parquet":
+		import pyarrow.parquet as pq
+		pq.write_table(table, output + ".tmp")
+	else:
+		with pa.OSFile(output + ".tmp", "wb") as sink:
+			with pa.ipc.new_file(sink, schema) as ipc:
+				ipc.write_table(table)
+	os.replace(output + ".tmp", output)
+
+
+def Store_Column(name):
+	# database column of a report column ("Mean Read Quality" -> mean_read_quality)
+	return name.strip().lower().replace(" ", "_")
+
+
+STORE_TYPES = { int: "INTEGER", float: "REAL", str: "TEXT" }
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs ( run INTEGER PRIMARY KEY, run_name TEXT NOT NULL, samples_path TEXT NOT NULL, reference TEXT, date TEXT,
+                                  UNIQUE (samples_path, run_name) );
+CREATE TABLE IF NOT EXISTS samples ( run INTEGER NOT NULL REFERENCES runs (run), sample_id TEXT NOT NULL, metadata TEXT, """ + \
+	", ".join([ Store_Column(name) + " " + STORE_TYPES[kind] for name, kind in REPORT_COLUMNS ]) + """,
+                                     PRIMARY KEY (run, sample_id) );
+CREATE TABLE IF NOT EXISTS mutations ( run INTEGER NOT NULL REFERENCES runs (run), """ + \
+	", ".join([ Store_Column(name) + " " + STORE_TYPES[kind] for name, kind in MUTATION_COLUMNS ]) + """ );
+CREATE INDEX IF NOT EXISTS mutations_site ON mutations (locus, position, mutation);
+CREATE INDEX IF NOT EXISTS mutations_sample ON mutations (sample_id);
+CREATE INDEX IF NOT EXISTS samples_sample ON samples (sample_id);
+"""
+
+
+def Open_Store(path):
+	# SQLite store of the samples and mutations of all runs written into it (tables created when missing)
+	store = sqlite3.connect(path, timeout = 60)
+	store.executescript(STORE_SCHEMA)
+	return store
+
+
+def Store_Run(store, samplesPath, runName, reference, date):
+	# id of the run in the store, a resumed run keeps the id of its first part
+	with store:
+		store.execute("INSERT OR IGNORE INTO runs (run_name, samples_path, reference, date) VALUES (?, ?, ?, ?)",
+		              (runName, os.path.abspath(samplesPath), os.path.abspath(reference), str(date)))
+	return store.execute("SELECT run FROM runs WHERE samples_path = ? AND run_name = ?", (os.path.abspath(samplesPath), runName)).fetchone()[0]
+
+
+def Store_Sample(store, run, header, sampleIDname, ReportRow, MutationRows):
+	# appends the report row and mutations of a sample in one transaction; a sample already stored for the run
+	# (reported again after a crash) is left as it is
+	QC = Typed_Row(REPORT_COLUMNS, ReportRow[len(header):])
+	with store:
+		added = store.execute("INSERT OR IGNORE INTO samples VALUES (" + ", ".join(["?"]*(3 + len(QC))) + ")",
+		                      [run, sampleIDname, json.dumps(dict(zip(header, ReportRow[:len(header)])))] + QC).rowcount
+		if added > 0:
+			store.executemany("INSERT INTO mutations VALUES (" + ", ".join(["?"]*(1 + len(MUTATION_COLUMNS))) + ")",
+			                  [ [run] + Typed_Row(MUTATION_COLUMNS, row) for row in MutationRows ])
+
+
+def Query_Store(store, filters, qc = False):
+	# [columns, rows] of the stored mutations matching the {column: value} filters, or with qc the QC stats of the
+	# samples (those carrying a matching mutation when mutation columns are filtered)
+	MUTATION = [ Store_Column(name) for name, kind in MUTATION_COLUMNS ]
+	table = "samples" if qc else "mutations"
+	columns = ["run_name", "samples_path"] + (["sample_id", "metadata"] + [ Store_Column(name) for name, kind in REPORT_COLUMNS ] if qc else MUTATION)
+	site = [ column for column in filters if qc and column in MUTATION and column != "sample_id" ]
+	where = [ ("runs." if column == "run_name" else table + ".") + column + " = ?" for column in filters if column not in site ]
+	values = [ value for column, value in filters.items() if column not in site ]
+	if len(site) > 0:
+		where.append("(samples.run, samples.sample_id) IN (SELECT run, sample_id FROM mutations WHERE " + " AND ".join([ column + " = ?" for column in site ]) + ")")
+		values = values + [ filters[column] for column in site ]
+	cursor = store.execute("SELECT " + ", ".join([ ("runs." if column in ["run_name", "samples_path"] else table + ".") + column for column in columns ]) +
+	                       " FROM " + table + " JOIN runs ON runs.run = " + table + ".run" + (" WHERE " + " AND ".join(where) if len(where) > 0 else "") +
+	                       " ORDER BY runs.run, " + table + ".sample_id" + ("" if qc else ", mutations.locus, mutations.position"), values)
+	return [columns, cursor.fetchall()]
+
+
 def VCF_TO_CONSENSUS_bcftools( VCFpath, ConsensusPath, ReferencePath, tempPath ):
 	temporaryVCFgz = tempPath + "/temporary.vcf.gz"  
 	command1 =  "bcftools convert -Oz -o " + temporaryVCFgz + " " + VCFpath
-	os.system(command1)
-	exist_status1 = os.system(command1)
+	Run_Command(command1, "bcftools convert")
 	command2 =  "bcftools index -f " + temporaryVCFgz
-	os.system(command2)
-	exist_status2 = os.system(command2)
-	command3 =  "bcftools consensus " + temporaryVCFgz + " -f " + ReferencePath + " o " + ConsensusPath
-	os.system(command3)
-	exist_status3 = os.system(command3) 
-	if (exist_status1 != 0) or (exist_status2 != 0) or (exist_status3 != 0):
-		print('Fail to run bcf tools for new consensus generation!\n please ensure that the tool is installed and run again')
-		exit(0)
+	Run_Command(command2, "bcftools index")
+	command3 =  "bcftools consensus " + temporaryVCFgz + " -f " + ReferencePath + " -o " + ConsensusPath
+	Run_Command(command3, "bcftools consensus")
 
 
-def BADsampleCheker( Spath, TempPath, H, T, L, minR ):
+def BADsampleCheker( STATS, H, T, L, minR ):
 	DECISON = "reject"
-	commands =  "NanoStat --fastq "  + Spath +  "  --tsv > " + TempPath 
-	os.system(commands)
-	MRL,  RLSTD, NTR =  0, 0, 0   
-	SF = open(TempPath)
-	for line in SF:
-		S = line.split("\t")
-		if S[0] == "mean_read_length":
-			MRL = float(S[1])
-		if S[0] == "read_length_stdev":
-			RLSTD= float(S[1])
-		if S[0] == "number_of_reads":
-			NTR= float(S[1])
+	MRL,  RLSTD, NTR =  STATS[0], STATS[1], STATS[3]
 	FN  = MRL - RLSTD - H - T     
 	if NTR >= minR and FN > L:
 		DECISON = "accept"   
@@ -522,57 +1465,253 @@ def BADsampleCheker( Spath, TempPath, H, T, L, minR ):
 
 
 def METAdataExtract (filepath):
-	FileName, IDname, Header, dataInfo, n = [],[] , "", [], 0 
-	f = open (filepath, "r" )
-	extension = filepath.split(".")[-1]
-	if  extension == "tsv":
-		S = "\t"
-	else:
-		S = ","
-	for line in f:
-		if line[0] != "#":
-			if n == 0:
-				HeaderInfo = line.split(S)
-				Header = HeaderInfo[0]
-				for H in HeaderInfo[1:]:
-					Header = Header + "," + H.split("\n")[0]
-			if n > 0 :
-				meta = line.split(S)
-				row = meta[0] 
-				for D in meta[1:]:
-					row = row + "," + D.split("\n")[0]
-				dataInfo.append(row)
-				FileName.append(line.split(S)[1].split("\n")[0])
-				IDname.append(line.split(S)[0].split("\n")[0]) 
-			n = n + 1
+	# metadata table (csv, or tsv by extension) indexed by file name and by sample ID, the first two columns
+	# {"header": [column], "rows": [[field]], "IDname": [...], "FileName": [...], "files": {file name: row}, "ids": {sample ID: row}}
+	# lines starting with # and empty lines are skipped, fields are stripped of surrounding whitespace
+	# empty fields past the header columns (trailing delimiters) are dropped, raises ValueError for a row with
+	# more fields than the header, so the report rows always have the columns of the report header
+	S = "\t" if filepath.split(".")[-1] == "tsv" else ","
+	metadata = {"header": [], "rows": [], "IDname": [], "FileName": [], "files": {}, "ids": {} }
+	f = open(filepath, "r", newline = "")
+	n = 0
+	READER = csv.reader(f, delimiter = S)
+	for fields in READER:
+		fields = [ field.strip() for field in fields ]
+		if len(fields) == 0 or fields[0].startswith("#") or fields == [""]*len(fields):
+			continue
+		while n > 0 and len(fields) > len(metadata["header"]) and fields[-1] == "":
+			fields.pop()
+		if n > 0 and len(fields) > len(metadata["header"]):
+			f.close()
+			raise ValueError("line " + str(READER.line_num) + " has " + str(len(fields)) + " fields for the " + str(len(metadata["header"])) + " header columns")
+		if n == 0:
+			metadata["header"] = fields
+		elif len(fields) > 1:
+			metadata["files"][fields[1]] = len(metadata["rows"])
+			metadata["ids"][fields[0]] = len(metadata["rows"])
+			metadata["rows"].append(fields)
+			metadata["IDname"].append(fields[0])
+			metadata["FileName"].append(fields[1])
+		n = n + 1
 	f.close()
-	return [Header, IDname, FileName, dataInfo ]
+	return metadata
+
+
+def Sample_Info(metadata, FileName, sampleIDname):
+	# metadata fields of a reads file, found by file name or else by sample ID, padded to the header columns
+	# (METAdataExtract rejects rows wider than the header, so the row has exactly the header columns)
+	row = metadata["files"].get(FileName, metadata["ids"].get(sampleIDname))
+	fields = [] if row == None else metadata["rows"][row]
+	return fields + [""]*(len(metadata["header"]) - len(fields))
+
+
+def Process_Sample(sample_reads_path, sampleIDname, sampleInfo, SampleNumber, outputpath, RefGenome_path, P):
+	# runs the whole analysis of one sample and returns [status, sample ID, report row, mutation rows]
+	# rows are returned instead of written, so that a single process writes the run reports
+	# each step is checkpointed in the run manifest, a resumed run starts at the first incomplete step
+	# the timings of the steps and commands of the sample are returned as a fifth item
+	del TIMINGS[:]
+	headcrop, tailcrop, minLen, minReads, minQReads = P["headcrop"], P["tailcrop"], P["minLen"], P["minReads"], P["minQReads"]
+	coverage_cutoff = P["coverage_cutoff"]
+	try:
+		FILTER = [minQReads, headcrop, tailcrop, minLen]
+		ManifestPath = Manifest_Path(outputpath)
+		Manifest = Load_Manifest(ManifestPath, sampleIDname)
+		# filtered (or merged chunks) reads are written in the run folder, not next to the raw reads
+		HQpath = os.path.dirname(outputpath) + "/" + sampleIDname + "_HQ.fastq.gz"
+		KEYS = { "filter": [FILTER, os.path.abspath(sample_reads_path), Reads_Signature(sample_reads_path), READS_STATS_VERSION],
+		         "medaka": [P["model"], RefGenome_path], "depth": [],
+		         "variants": [coverage_cutoff, P["BadRegions"], P["minfreq"], P["maxINDELs"]], "consensus": [],
+		         "report": [P["mafft"], P["ideal_cutoff"], P["minCOV2"], P["plots"], sampleInfo, SampleNumber], "finalize": [sampleInfo] }
+		clock = Step_Clock()
+		Resume = Resume_Step(Manifest, KEYS)
+		Record_Step("resume check", clock)
+		if Resume == len(MANIFEST_STEPS):
+			UnecessaryFiles_remove(HQpath, outputpath)
+			return Manifest["steps"]["finalize"]["result"] + [ list(TIMINGS) ]
+		if Resume > 0:
+			print("\n ...resuming sample", sampleIDname, "at the", MANIFEST_STEPS[Resume], "step")
+		TODO = MANIFEST_STEPS[Resume:]
+		if "filter" in TODO:
+			clock = Step_Clock()
+			# reads statistics of previous runs (of any run name, in the shared cache folder, kept while the reads path, size
+			# and mtime are unchanged) let rejected and unfiltered (-q 0) samples be decided without reading the file again;
+			# accepted samples with a filter still stream the reads, medaka needs the filtered file
+			HQsample_reads_path = sample_reads_path
+			StatsCache = Reads_Stats_Path(P["cache"], sample_reads_path, FILTER)
+			STATS = Cached_Reads_Stats(StatsCache, sample_reads_path, FILTER)
+			if STATS != None:
+				sample_reads_stats, final_reads_stats = STATS
+			HQneeded = minQReads != 0 or os.path.isdir(sample_reads_path)
+			if STATS == None or (HQneeded and BADsampleCheker( sample_reads_stats , headcrop , tailcrop, minLen, minReads ) == "accept" and BADsampleCheker( final_reads_stats , headcrop , tailcrop, minLen, minReads ) == "accept"):
+				if minQReads == 0 and not os.path.isdir(sample_reads_path):
+					sample_reads_stats = Reads_Stats(sample_reads_path)
+					final_reads_stats = sample_reads_stats
+				elif minQReads == 0:
+					# medaka takes a single reads file, the chunks are merged by streaming them through the filter without cuts
+					HQsample_reads_path, sample_reads_stats, final_reads_stats = HQfilterReads( sample_reads_path, -1, 0, 0, 0, HQpath )
+				else:
+					HQsample_reads_path, sample_reads_stats, final_reads_stats = HQfilterReads( sample_reads_path, minQReads, headcrop, tailcrop, minLen, HQpath )
+				Store_Reads_Stats(StatsCache, sample_reads_path, FILTER, sample_reads_stats, final_reads_stats)
+			Record_Step("filter", clock)
+			QCcheck1 = BADsampleCheker( sample_reads_stats , headcrop , tailcrop, minLen, minReads )
+			QCcheck2 = BADsampleCheker( final_reads_stats , headcrop , tailcrop, minLen, minReads )
+			if QCcheck1 == "reject" or QCcheck2 == "reject":
+				if HQsample_reads_path != sample_reads_path:
+					os.remove(HQsample_reads_path)
+				return ["reject", sampleIDname, "", [], list(TIMINGS) ]
+			HQoutputs = [ HQsample_reads_path ] if HQsample_reads_path != sample_reads_path else []
+			Checkpoint(ManifestPath, Manifest, "filter", KEYS["filter"], HQoutputs, {"stats": [sample_reads_stats, final_reads_stats]})
+		else:
+			sample_reads_stats, final_reads_stats = Manifest["steps"]["filter"]["stats"]
+			HQoutputs = list(Manifest["steps"]["filter"]["outputs"])
+			HQsample_reads_path = HQoutputs[0] if len(HQoutputs) > 0 else sample_reads_path
+		BAMfile, ProbFile, Consensus = Medaka_Outputs(outputpath)
+		if "medaka" in TODO:
+			clock = Step_Clock()
+			Medaka_consensus_prediction (HQsample_reads_path , RefGenome_path , P["model"], outputpath, P["threads"])
+			Write_Reads_Stats(final_reads_stats, outputpath , "FilteredStatsReport") 
+			Write_Reads_Stats(sample_reads_stats, outputpath , "InitialStatsReport")
+			Record_Step("medaka", clock)
+			Checkpoint(ManifestPath, Manifest, "medaka", KEYS["medaka"], [BAMfile, ProbFile])
+		if "depth" in TODO:
+			clock = Step_Clock()
+			SampleCoverageFile, DEPTH = CoverageExtraction(BAMfile, P["depth_engine"])
+			Record_Step("depth", clock)
+			Checkpoint(ManifestPath, Manifest, "depth", KEYS["depth"], [SampleCoverageFile])
+		else:
+			SampleCoverageFile, DEPTH = list(Manifest["steps"]["depth"]["outputs"])[0], None
+		BadReg = P["BadRegions"]
+		if "variants" in TODO:
+			clock = Step_Clock()
+			VCFfile = VariantCalling_Medaka(ProbFile, RefGenome_path, BAMfile)
+			VARIANTS = Refine_medaka_VCF_with_coverage_and_frequency (VCFfile,coverage_cutoff , BadReg, P["minfreq"] , P["maxINDELs"])
+			Record_Step("variants", clock)
+			Checkpoint(ManifestPath, Manifest, "variants", KEYS["variants"], [VCFfile])
+		else:
+			VCFfile = list(Manifest["steps"]["variants"]["outputs"])[0]
+			VARIANTS = Get_Variant_INFO_fromVCF(VCFfile)
+		# the bcftools and the masked consensus are kept in their own (temporary) files and consensus.fasta is only
+		# written by the finalize step, so no step rewrites a file hashed in the checkpoint of an earlier step
+		Unmasked, Masked = outputpath + "/temporary.consensus.fasta", outputpath + "/temporary.masked.fasta"
+		if "consensus" in TODO:
+			clock = Step_Clock()
+			VCF_TO_CONSENSUS_bcftools( VCFfile, Unmasked, RefGenome_path, outputpath  )
+			Record_Step("consensus", clock)
+			Checkpoint(ManifestPath, Manifest, "consensus", KEYS["consensus"], [Unmasked])
+		reference_sequence = P["reference"]
+		if "report" in TODO:
+			clock = Step_Clock()
+			# consensus segments are matched to the reference segments by ID, whatever their order in the consensus
+			consensus_sequence_unmasked = { seq[0]: seq for seq in import_seqs(Unmasked) }
+			ALIGNMENTS, MAFFT_PAIRS = {}, []
+			for RefSeq in reference_sequence: 
+				if RefSeq[0] not in consensus_sequence_unmasked:
+					raise ToolError("The consensus has no sequence for the reference segment " + RefSeq[0])
+				Allign = None
+				if not P["mafft"]:
+					Allign = Alignment_From_Variants ( RefSeq , consensus_sequence_unmasked[RefSeq[0]] , VARIANTS )
+					if Allign == None:
+						print("\n ...consensus of", RefSeq[0], "does not match the variants, aligning with mafft")
+				if Allign == None:
+					MAFFT_PAIRS.append([ RefSeq, consensus_sequence_unmasked[RefSeq[0]] ])
+				else:
+					ALIGNMENTS[RefSeq[0]] = Allign
+			ALIGNMENTS.update( Segment_Alignments_MAFFT( MAFFT_PAIRS, outputpath, P["threads"] ) )
+			Allign_seqs = []
+			for RefSeq in reference_sequence: 
+				Allign_seqs =  Allign_seqs + ALIGNMENTS[RefSeq[0]]
+			Record_Step("alignment", clock)
+			clock = Step_Clock()
+			if DEPTH == None:
+				DEPTH = Load_Depth(SampleCoverageFile)
+			Mask =  LowCov_SeqMasker (Allign_seqs, DEPTH  , Masked, coverage_cutoff, BadReg)
+			Record_Step("masking", clock)
+			DepthVALUES = np.concatenate(DEPTH["depth"])
+			SampleSequenceCoverage = round( (Mask[1] - Mask[0])/ Mask[1] *100 , 1 )
+			# plots are drawn for all samples or the flagged ones, or their data is saved to draw them off the batch
+			PlotFiles = []
+			if P["plots"] == "all" or (P["plots"] == "flagged" and SampleSequenceCoverage <= P["minCOV2"]):
+				clock = Step_Clock()
+				CoverageQuality_Plot( coverage_cutoff , P["ideal_cutoff"], DEPTH , VARIANTS, outputpath + "/" )
+				Record_Step("plot", clock)
+				PlotFiles = [ outputpath + "/coverageQualityPlot.png" ]
+			if P["plots"] == "deferred":
+				Save_Plot_Data( outputpath + "/" + PLOT_DATA, coverage_cutoff , P["ideal_cutoff"], DEPTH , VARIANTS, SampleSequenceCoverage <= P["minCOV2"] )
+				PlotFiles = [ outputpath + "/" + PLOT_DATA ]
+			MutationRows = []
+			for i in range(len(VARIANTS["pos"])):
+				Muti = VARIANTS["ref"][i] + "-->" + VARIANTS["alt"][i]
+				Typi = MUTATION_TYPES[VARIANTS["type"][i]]
+				seqi = VARIANTS["contigs"][VARIANTS["contig"][i]]
+				MutationRows.append( [ SampleNumber, sampleIDname, Muti, Typi, seqi, int(VARIANTS["pos"][i]), float(VARIANTS["FREQ"][i]), int(VARIANTS["DP"][i]) ] )
+			mutation_count = len(VARIANTS["pos"])
+			tI = np.count_nonzero(VARIANTS["type"] == MUTATION_TYPES.index("Insertion"))
+			tD = np.count_nonzero(VARIANTS["type"] == MUTATION_TYPES.index("Deletion"))
+			ISD = final_reads_stats
+			SSD = sample_reads_stats
+			if SampleSequenceCoverage > P["minCOV2"] :
+				Message = "Sample with good quality"
+			else:
+				Message = "Warning: Not enough sequence coverage"
+			AverageCoverage = int( int(DepthVALUES.sum(dtype = np.int64)) / len(DepthVALUES) )
+			# report row: the metadata fields followed by the REPORT_COLUMNS values
+			ColumnValues = sampleInfo + Typed_Row( REPORT_COLUMNS, [ SSD[2], SSD[0], SSD[3], SSD[4], AverageCoverage, SampleSequenceCoverage, Mask[0], mutation_count,
+			                                                         tI, tD, Mask[3], ISD[2], ISD[0], ISD[3], ISD[4], Message ] )
+			Checkpoint(ManifestPath, Manifest, "report", KEYS["report"], [Masked] + PlotFiles, {"result": ["accept", sampleIDname, ColumnValues, MutationRows ]})
+		Result = Manifest["steps"]["report"]["result"]
+		RefHeader = [ seqinfo[0] for seqinfo in reference_sequence ]
+		shutil.copyfile(Masked, Consensus)
+		Add_SampleIDinfo_fasta( Consensus , sampleIDname, RefHeader )     #  Manipulation of Consensus file header 
+		Checkpoint(ManifestPath, Manifest, "finalize", KEYS["finalize"], [SampleCoverageFile, Consensus], {"result": Result})
+		UnecessaryFiles_remove(HQpath, outputpath) 
+		return Result + [ list(TIMINGS) ]
+	except ToolError as error:
+		print("\n ...sample", sampleIDname, "failed:", error)
+		return ["failed", sampleIDname, "", [], list(TIMINGS) ]
+	except Exception as error:
+		# any other error (unexpected file contents, python steps) fails only this sample, with its traceback
+		print("\n ...sample", sampleIDname, "failed with an unexpected error:", repr(error))
+		traceback.print_exc()
+		return ["failed", sampleIDname, "", [], list(TIMINGS) ]
 
 
-def pipeline():
+def Choose_Path(title, filetypes = None):
+	# path picked in a file dialog (a folder when no filetypes are given), tkinter is only imported for the choose option
+	from tkinter import Tk, filedialog
+	Tk().withdraw()
+	if filetypes == None:
+		return filedialog.askdirectory(title = title)
+	return filedialog.askopenfilename(title = title, filetypes = filetypes)
+
+
+def pipeline(ARGS):
     start = time.time()
     print ("===============================================================================")
     print ("  AUTOMATED PIPELINE alpha for miniON NGS data processing  (alpha version)  ")
     print ("===============================================================================")
     if ARGS.PATH == "choose":
-        Tk().withdraw()
-        path = askdirectory(title = "open folder with  multiple sample reads files from MiniON" )
+        path = Choose_Path("open folder with  multiple sample reads files from MiniON" )
     else:
         path = ARGS.PATH
 
     if ARGS.REFGENOME == "choose":      
-        Tk().withdraw()
-        RefGenome_path = filedialog.askopenfilename( title = "open reference genome fasta file", filetypes=[("fasta","*.fasta")] )
+        RefGenome_path = Choose_Path( "open reference genome fasta file", [("fasta","*.fasta")] )
     else:
         RefGenome_path = ARGS.REFGENOME 
 
     if ARGS.META == "choose":      
-        Tk().withdraw()
-        metapath = filedialog.askopenfilename( title = "open metadata file", filetypes=[("csv files","*.csv"), ("tsv files","*.tsv") ] )
-        metadata = METAdataExtract(metapath)
+        metapath = Choose_Path( "open metadata file", [("csv files","*.csv"), ("tsv files","*.tsv") ] )
     else:
-        metadata = METAdataExtract(ARGS.META)
-    FILES = os.listdir (path)
+        metapath = ARGS.META
+    try:
+        metadata = METAdataExtract(metapath)
+    except ValueError as error:
+        print("Invalid metadata file", metapath, ":", error, "\n please fix the row (one field per header column) and run again the pipeline")
+        exit(0)
+    READS, Missing_data = Discover_Samples(path, metadata)
+    if len(Missing_data) > 0:
+        print("\n", len(Missing_data), "samples listed in the metadata have no reads file in", path, ":\n\t" + "\t".join(Missing_data))
     RUNfolder = ARGS.RUN_NAME
     model = ARGS.MODEL            
     coverage_cutoff = ARGS.CUTOFF1       
@@ -586,131 +1725,188 @@ def pipeline():
     cutRegions = ARGS.IGNORE_REGIONS             
     minReads  = ARGS.MINREADSN                   
     minCOV2 = ARGS.MINSEQCOV                     
-    if not os.path.exists(path + "/" + RUNfolder):
-        os.mkdir(path + "/" + RUNfolder)
-    else:
-        CHOICE = input( "Analysis name already exists! Press y to continue (it carries on the remaining files to be processed) :\n")
-        if CHOICE != "y":
-            print("Please run again the tool and provide a new analysis name")
-            exit(0)                         
-    Headers = "NO"
-    if not os.path.exists(path + "/" + RUNfolder + "/miniON_Data_ProcessingReport.csv"):
-	    Headers = "YES"
-    ReportFile = open(path + "/" + RUNfolder + "/miniON_Data_ProcessingReport.csv", "a")
-    MutationsFile = open(path + "/" + RUNfolder + "/Detected_Mutations.csv", "a")
-    if Headers == "YES":
-	    ColumnsNames = metadata[0] + ",Mean Read Quality,Mean Reads Size,Total Number Reads,Total Number Bases,Average Coverage,Consensus sequence coverage,Number Masked Bases,Detected mutations,Number Insertions,Number Deletions,Sequence gaps, Mean Read Quality After Filter,Mean Reads Size After Filter,Number Reads After Filter,Number Bases After Filter,Sample Status\n"  
-	    MutationsFile.write("Sample Number,Sample ID,Mutation,Type,Locus,Position,Frequency,Coverage\n") 
-	    ReportFile.write(ColumnsNames) 
-    Rejected_data = []
-    DATE = datetime.datetime.now() 
-    N, T = 0, 0 
-    for FileName in FILES:
-        fileType, RUNsample = "none", "Ignore"
-        Fi = FileName.split(".")
-        if len(FileName.split(".")) > 1 and len(FileName.split("_HQ") ) == 1:
-            fileType = FileName.split(".")[1]
-            if fileType == "fastq":
-                T = T + 1
-                sample_reads_path = path + "/" + FileName
-                sampleIDname = Get_Sample_IDname(sample_reads_path)	
-                if not os.path.exists(path + "/" + RUNfolder + "/" + sampleIDname ):
-                    RUNsample = "YES"
-        if fileType == "fastq" and RUNsample != "Ignore" and (FileName in metadata[2]):
-            N = N +1
-            print("\n\n\n ...processing sample ", T, "(",FileName.split(".")[0], ")"  )
-            sample_reads_path = path + "/" + FileName		
+    jobs = max(1, ARGS.JOBS)
+    depth_engine = ARGS.DEPTH_ENGINE
+    if depth_engine == "auto":
+        depth_engine = "pysam" if Module_Available("pysam") else "samtools"
+    if depth_engine == "pysam" and not Module_Available("pysam"):
+        print("The pysam depth engine needs the pysam package, please install it (pip install pysam) or use --depth_engine samtools")
+        exit(0)
+    if ARGS.COLUMNAR != "none" and not Module_Available("pyarrow"):
+        print("Columnar outputs need the pyarrow package, please install it (pip install pyarrow) or use --columnar none")
+        exit(0)
+    try:
+        BadRegions = Generate_Bad_regions_index(cutRegions, Fasta_IDs(RefGenome_path))
+    except (ValueError, IndexError) as error:
+        print("Invalid ignore regions (-u):", error, "\n please use locus:start-end;... or a BED file and run again the pipeline")
+        exit(0)
+    except OSError as error:
+        print("Could not read the reference:", error)
+        exit(0)
+    if os.path.exists(path + "/" + RUNfolder) and not ARGS.RESUME:
+        print("Analysis name already exists! Please run again the tool with a new analysis name, or with --resume to carry on the remaining files to be processed")
+        exit(0)                         
+    try:
+        RefCache, RefCache_path, Reference = Prepare_Reference_Cache(RefGenome_path, ARGS.REFCACHE, depth_engine)   # indexed and parsed once, shared by all samples
+        TIMING_ROWS = [ ["reference"] + row for row in TIMINGS ]
+    except (ToolError, OSError) as error:
+        print("Could not prepare the reference indexes:", error)
+        exit(0)
+    # from here on the run is registered in the reference cache, it is released however the run ends
+    try:
+        Prune_Reads_Stats(ARGS.REFCACHE)
+        Parameters = { "model": model, "coverage_cutoff": coverage_cutoff, "ideal_cutoff": ideal_cutoff, "minQReads": minQReads,
+                       "headcrop": headcrop, "tailcrop": tailcrop, "minLen": minLen, "minfreq": minfreq, "maxINDELs": maxINDELs,
+                       "BadRegions": BadRegions, "minReads": minReads, "minCOV2": minCOV2, "threads": Thread_Budget(jobs), "mafft": ARGS.MAFFT, "reference": Reference, "plots": ARGS.PLOTS, "depth_engine": depth_engine, "cache": ARGS.REFCACHE }
+        os.makedirs(path + "/" + RUNfolder, exist_ok = True)
+        Write_Timings(path + "/" + RUNfolder, "reference", [ row[1:] for row in TIMING_ROWS ])
+        ReportColumns = [ [name, str] for name in metadata["header"] ] + REPORT_COLUMNS
+        ReportFile = Open_Report(path + "/" + RUNfolder + "/miniON_Data_ProcessingReport.csv", ReportColumns)
+        MutationsFile = Open_Report(path + "/" + RUNfolder + "/Detected_Mutations.csv", MUTATION_COLUMNS)
+        Store = None
+        if ARGS.DATABASE != "none":
+            Store = Open_Store(ARGS.DATABASE)
+            StoreRun = Store_Run(Store, path, RUNfolder, RefGenome_path, datetime.datetime.now())
+        Rejected_data, Failed_data = [], []
+        DATE = datetime.datetime.now() 
+        N, T, Nrun = 0, 0, 0 
+        SAMPLES = []
+        for FileName, sample_reads_path in READS:
+            T = T + 1
             sampleIDname = Get_Sample_IDname(sample_reads_path)
-            sampleInfo = ""
-            for i, info in enumerate(metadata[2]):
-                if info == FileName or metadata[1][i] == sampleIDname:
-                    sampleInfo = metadata[3][i] 
-            outputpath = path + "/" + RUNfolder + "/" + sampleIDname
-            TemporarySTATS = path + "/" + RUNfolder + "/temporary.txt"
-            QCcheck1 = BADsampleCheker( sample_reads_path , TemporarySTATS , headcrop , tailcrop, minLen, minReads )
-            if minQReads == 0 and QCcheck1 != "reject":
-                HQsample_reads_path = sample_reads_path
-                QCcheck2 = QCcheck1 
-            if minQReads != 0 and QCcheck1 != "reject":
-                HQsample_reads_path = HQfilterReads( sample_reads_path, minQReads, headcrop, tailcrop, minLen  )
-                QCcheck2 = BADsampleCheker( HQsample_reads_path , TemporarySTATS , headcrop , tailcrop, minLen, minReads )
-            if QCcheck1 != "reject" and QCcheck2 != "reject":
-                MedakaOutputs = Medaka_consensus_prediction (HQsample_reads_path , RefGenome_path , model, outputpath)
-                Consensus = MedakaOutputs[2]   
-                ProbFile = MedakaOutputs[1]    
-                BAMfile = MedakaOutputs[0]  
-                final_reads_stats = Reads_Stats(HQsample_reads_path, outputpath , "FilteredStatsReport") 
-                sample_reads_stats = Reads_Stats(sample_reads_path, outputpath , "InitialStatsReport")
-                SampleCoverageFile = CoverageExtraction(BAMfile)
-                VCFfile = VariantCalling_Medaka(ProbFile, RefGenome_path, BAMfile)
-                BadReg = Generate_Bad_regions_index (cutRegions)
-                Refine_medaka_VCF_with_coverage_and_frequency (VCFfile,coverage_cutoff , BadReg, minfreq , maxINDELs)
-                MutINFO = Get_Variant_INFO_fromVCF(VCFfile ) 
-                VCF_TO_CONSENSUS_bcftools( VCFfile, Consensus, RefGenome_path, outputpath  )
-                consensus_sequence_unmasked = import_seqs(Consensus)
-                reference_sequence = import_seqs(RefGenome_path)
-                Allign_seqs = []
-                for seg in range(len(reference_sequence)): 
-                    Allign_file = Run_Alingment_MAFFT ( reference_sequence[seg] , consensus_sequence_unmasked[seg] , outputpath ) 
-                    Allign_seqs =  Allign_seqs + import_seqs(Allign_file)
-                Mask =  LowCov_SeqMasker (Allign_seqs, SampleCoverageFile  , Consensus, coverage_cutoff, BadReg)
-                DepthVALUES = CoverageQuality_Plot( coverage_cutoff , ideal_cutoff, SampleCoverageFile , MutINFO )
-                mutation_count, tI, tD = 0, 0,0   
-                for i, INFO in enumerate(MutINFO[0]):
-                    Pi = int(float(INFO))
-                    Muti = MutINFO[1][i]
-                    FREQi = float(MutINFO[2][i])
-                    Typi = MutINFO[3][i] 
-                    Covi = int(float(MutINFO[5][i])) 
-                    seqi = MutINFO[4][i]       
-                    mutation_count = mutation_count + 1
-                    MutationsFile.write(  str(N) + "," + sampleIDname + "," +   Muti   + "," +  Typi  + "," +  seqi   + "," + str(Pi) + "," +  str(FREQi)  + "," + str(Covi) + "\n"  )
-                    if Typi =="Insertion":
-                        tI += tI + 1
-                    if Typi =="Deletion":
-                        tD = tD + 1  
-                ISD = final_reads_stats
-                SSD = sample_reads_stats
-                SampleSequenceCoverage = round( (Mask[1] - Mask[0])/ Mask[1] *100 , 1 )
-                if SampleSequenceCoverage > minCOV2 :
-                    Message = "Sample with good quality"
-                else:
-                    Message = "Warning: Not enough sequence coverage"
-                C2, C3, C4, C5 = str(SSD[2]).split("\n")[0] , str(SSD[0]).split("\n")[0], str(SSD[3]).split("\n")[0], str(SSD[4]).split("\n")[0] 
-                C6, C7, C8, C10, C11, C12 =str(int((sum(DepthVALUES)/len(DepthVALUES) ))),  str(SampleSequenceCoverage), str(Mask[0]),  str(tI) , str(tD)  , str(Mask[3])
-                C13, C14, C15, C16 = str(ISD[2]).split("\n")[0], str(ISD[0]).split("\n")[0], str(ISD[3]).split("\n")[0], str(ISD[4]).split("\n")[0]  
-                C9, C1  = str(mutation_count), Message
-                ColumnValues = sampleInfo + "," + C2+ "," + C3+ "," + C4 + "," + C5 + "," + C6+ "," + C7+ "," + C8+ "," + C9+ "," + C10+ "," + C11+"," + C12 +"," +  C13+"," + C14+"," + C15+"," + C16+ "," + C1 +  "\n"
-                ReportFile.write(ColumnValues)
-                avTime = float(time.time() - start)/N
-                WriteParametersReport ( path + "/" + RUNfolder + "/" , RefGenome_path, model,coverage_cutoff, minQReads, headcrop, tailcrop, cutRegions, RUNfolder, T, avTime, DATE ) 
-                GunZip_Files( [ SampleCoverageFile ] )
-                RefHeader = [ seqinfo[0] for seqinfo in reference_sequence ]
-                Add_SampleIDinfo_fasta( Consensus , sampleIDname, RefHeader )     #  Manipulation of Consensus file header 
-                UnecessaryFiles_remove(RefGenome_path, sample_reads_path, outputpath, TemporarySTATS, minQReads) 
-            if QCcheck1 == "reject" or QCcheck2 == "reject":
-                Rejected_data.append(sampleIDname)
-                if QCcheck1 != "reject":
-                    os.remove(HQsample_reads_path)
-    pTime = time.time() - start
-    print ("\n\nREPORT SUMMARY")
-    print ("================================================================================================")
-    print ("              Total number of samples analysed    = ", T )
-    print ("              Total number of samples rejected    = ", len(Rejected_data) )
-    print ("              Total number of samples acceptable  = ", T - len(Rejected_data)   )
-    print ("              Total pipeline processing time      = ", round(pTime/60 , 1 ), " minutes ")
-    print ("              Average processing time per sample  = ", round(pTime/N/60 , 1 ), " minutes ")
-    print ("================================================================================================")
-    print("\n\nRejected samples with not enough data quality for analysis:\n")
-    RejS = ""
-    for S in Rejected_data:
-        RejS = RejS + "\t" + S 
-    print (RejS)
-    print ("\n**********************END**OF*PROCESS*****THANK*YOU*********************************************")
-    print ("      alpha version tool developed by Ricardo Jorge Pais (last updated on April 2021)             ")
-    print ("************************************************************************************************")
-    ReportFile.close()
-    MutationsFile.close()
+            if not Load_Manifest(Manifest_Path(path + "/" + RUNfolder + "/" + sampleIDname), sampleIDname)["reported"]:
+                N = N +1
+                sampleInfo = Sample_Info(metadata, FileName, sampleIDname)
+                outputpath = path + "/" + RUNfolder + "/" + sampleIDname
+                SAMPLES.append([sample_reads_path, sampleIDname, sampleInfo, N, outputpath, RefCache_path, Parameters])
+        if jobs == 1:
+            RESULTS = ( Process_Sample(*sample) for sample in SAMPLES )
+        else:
+            print("\n ...processing", len(SAMPLES), "samples with", jobs, "parallel jobs (", Parameters["threads"], "medaka threads per job )")
+            Pool = ProcessPoolExecutor(max_workers = jobs)
+            RESULTS = ( future.result() for future in as_completed([ Pool.submit(Process_Sample, *sample) for sample in SAMPLES ]) )
+        PlotPool, PLOTS = None, []
+        if ARGS.PLOTS == "deferred":
+            PlotPool = ProcessPoolExecutor(max_workers = Plot_Workers(jobs))     # plots are drawn off the batch, as samples finish
+        for sample in SAMPLES:
+            if jobs == 1:
+                print("\n\n\n ...processing sample ", sample[3], "(", sample[1], ")"  )
+            Result = next(RESULTS)
+            Write_Timings(path + "/" + RUNfolder, Result[1], Result[4])
+            TIMING_ROWS = TIMING_ROWS + [ [Result[1]] + row for row in Result[4] ]
+            # single writer of the run reports, rows are written whole and synced to disk as each sample finishes
+            if Result[0] == "accept":
+                Write_Report_Rows(MutationsFile, Result[3])
+                Write_Report_Rows(ReportFile, [ Result[2] ])
+                Sync_Reports([ MutationsFile, ReportFile ])
+                if ARGS.COLUMNAR != "none":
+                    Write_Columnar(path + "/" + RUNfolder + "/Columnar/miniON_Data_ProcessingReport", Result[1], ReportColumns, [ Result[2] ], ARGS.COLUMNAR)
+                    Write_Columnar(path + "/" + RUNfolder + "/Columnar/Detected_Mutations", Result[1], MUTATION_COLUMNS, Result[3], ARGS.COLUMNAR)
+                if Store != None:
+                    Store_Sample(Store, StoreRun, metadata["header"], Result[1], Result[2], Result[3])
+                Manifest = Load_Manifest(Manifest_Path(path + "/" + RUNfolder + "/" + Result[1]), Result[1])
+                Manifest["reported"] = True
+                Save_Manifest(Manifest_Path(path + "/" + RUNfolder + "/" + Result[1]), Manifest)
+                if PlotPool != None and os.path.exists(path + "/" + RUNfolder + "/" + Result[1] + "/" + PLOT_DATA):
+                    PLOTS.append([ Result[1], PlotPool.submit(Render_Plot_Data, path + "/" + RUNfolder + "/" + Result[1] + "/" + PLOT_DATA) ])
+            if Result[0] == "reject":
+                Rejected_data.append(Result[1])
+            if Result[0] == "failed":
+                Failed_data.append(Result[1])
+            Nrun = Nrun + 1
+            WriteParametersReport ( path + "/" + RUNfolder + "/" , RefGenome_path, model,coverage_cutoff, minQReads, headcrop, tailcrop, cutRegions, RUNfolder, T, Nrun, time.time() - start, DATE ) 
+        if jobs > 1:
+            Pool.shutdown()
+        if PlotPool != None:
+            print("\n ...waiting for", len(PLOTS), "deferred coverage plots")
+            for sampleIDname, future in PLOTS:
+                try:
+                    row = future.result()
+                    Write_Timings(path + "/" + RUNfolder, sampleIDname, [ row ])
+                    TIMING_ROWS = TIMING_ROWS + [ [sampleIDname] + row ]
+                except Exception as error:
+                    print("\n ...coverage plot of", sampleIDname, "failed:", error)
+            PlotPool.shutdown()
+        pTime = time.time() - start
+        Write_Timings_JSON(path + "/" + RUNfolder, TIMING_ROWS, pTime)
+        print ("\n\nREPORT SUMMARY")
+        print ("================================================================================================")
+        print ("              Total number of samples analysed    = ", T )
+        print ("              Total number of samples rejected    = ", len(Rejected_data) )
+        print ("              Total number of samples failed      = ", len(Failed_data) )
+        print ("              Samples in metadata without reads   = ", len(Missing_data) )
+        print ("              Total number of samples acceptable  = ", T - len(Rejected_data) - len(Failed_data)  )
+        print ("              Total pipeline processing time      = ", round(pTime/60 , 1 ), " minutes ")
+        print ("              Average processing time per sample  = ", round(pTime/max(N, 1)/60 , 1 ), " minutes ")
+        print ("================================================================================================")
+        print ("\n\nTIMINGS SUMMARY (all samples, see timings.tsv and timings.json for each sample)")
+        print ("================================================================================================")
+        print ("  %-24s %-8s %6s %12s %12s %14s" % ("step / command", "kind", "count", "wall (s)", "cpu (s)", "peak RSS (MB)"))
+        for name, item in sorted(Timings_Summary(TIMING_ROWS).items(), key = lambda entry: -entry[1][2]):
+            print ("  %-24s %-8s %6d %12.1f %12.1f %14s" % (name, item[0], item[1], item[2], item[3], "" if item[4] == None else "%.1f" % item[4]))
+        print ("================================================================================================")
+        print("\n\nRejected samples with not enough data quality for analysis:\n")
+        RejS = ""
+        for S in Rejected_data:
+            RejS = RejS + "\t" + S 
+        print (RejS)
+        if len(Failed_data) > 0:
+            print("\n\nFailed samples (external tool or processing error, see messages above):\n")
+            print("\t" + "\t".join(Failed_data))
+        print ("\n**********************END**OF*PROCESS*****THANK*YOU*********************************************")
+        print ("      alpha version tool developed by Ricardo Jorge Pais (last updated on April 2021)             ")
+        print ("************************************************************************************************")
+        Close_Reports([ ReportFile, MutationsFile ])
+        if Store != None:
+            Store.close()
+    finally:
+        Release_Reference_Cache(RefCache)
+
+
+def render_plots(RARGS):
+    # render-plots command: draws the coverage plots saved by a run with --plots deferred
+    FILES = sorted([ entry.path + "/" + PLOT_DATA for entry in os.scandir(RARGS.RUN) if entry.is_dir() and os.path.exists(entry.path + "/" + PLOT_DATA) ])
+    if RARGS.FLAGGED:
+        FILES = [ File for File in FILES if bool(np.load(File)["flagged"]) ]
+    print(" ...drawing", len(FILES), "coverage plots")
+    Pool = ProcessPoolExecutor(max_workers = max(1, RARGS.JOBS))
+    PLOTS = [ [ os.path.basename(os.path.dirname(File)), Pool.submit(Render_Plot_Data, File) ] for File in FILES ]
+    failed = 0
+    for sampleIDname, future in PLOTS:
+        try:
+            future.result()
+        except Exception as error:
+            print(" ...coverage plot of", sampleIDname, "failed:", error)
+            failed = failed + 1
+    Pool.shutdown()
+    print(" ...done,", len(FILES) - failed, "coverage plots drawn")
+
+
+def query(QARGS):
+    # query command: mutations (or samples QC stats) of the runs stored in a database, as csv on the standard output
+    if not os.path.exists(QARGS.DATABASE):
+        print("Database", QARGS.DATABASE, "not found")
+        exit(0)
+    start = time.time()
+    FILTERS = { "mutation": QARGS.MUTATION, "locus": QARGS.LOCUS, "position": QARGS.POSITION, "sample_id": QARGS.SAMPLE, "run_name": QARGS.RUN }
+    Store = Open_Store(QARGS.DATABASE)
+    columns, rows = Query_Store(Store, { column: value for column, value in FILTERS.items() if value != None }, QARGS.QC)
+    Store.close()
+    writer = csv.writer(sys.stdout, lineterminator = "\n")
+    writer.writerow(columns)
+    writer.writerows(rows)
+    sys.stderr.write(str(len(rows)) + " rows (" + str(round((time.time() - start)*1000, 1)) + " ms)\n")
+
+
+def main(argv = None):
+    argv = sys.argv[1:] if argv == None else argv
+    if argv[:1] == ["render-plots"]:
+        render_plots(Render_Parser().parse_args(argv[1:]))
+    elif argv[:1] == ["query"]:
+        query(Query_Parser().parse_args(argv[1:]))
+    else:
+        pipeline(Pipeline_Parser().parse_args(argv))
+
 
 if __name__ == "__main__":
-    pipeline() 
+    main() 
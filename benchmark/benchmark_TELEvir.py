@@ -0,0 +1,301 @@
+
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+
+PARSER = argparse.ArgumentParser(description = """
+OFFLINE BENCHMARK OF THE AMP TELEVIR CLI
+
+Generates synthetic references (single and multi segment), fastq files with controlled length and quality
+distributions, samtools depth files and medaka style annotated VCFs, times the python stages of the pipeline
+at several scales and runs the whole pipeline with stub executables standing in for medaka, samtools, minimap2,
+bcftools and mafft (benchmark/stub_tools.py). Results are written as JSON, so runs can be compared over time:
+
+    python benchmark/benchmark_TELEvir.py -o before.json
+    python benchmark/benchmark_TELEvir.py -o after.json -c before.json
+""", formatter_class = argparse.RawDescriptionHelpFormatter )
+PARSER.add_argument( "--scales", "-s", help = "Comma separated scales to run (small, medium, large; default = small,medium)\n", type = str, dest = "SCALES", default = "small,medium" )
+PARSER.add_argument( "--repeats", "-r", help = "Repetitions of each stage, the best and median times are reported (default = 3)\n", type = int, dest = "REPEATS", default = 3 )
+PARSER.add_argument( "--samples", "-n", help = "Number of samples of the full pipeline run (default = 4, 0 skips the pipeline run)\n", type = int, dest = "SAMPLES", default = 4 )
+PARSER.add_argument( "--jobs", "-j", help = "Parallel jobs of the full pipeline run (default = 1)\n", type = int, dest = "JOBS", default = 1 )
+PARSER.add_argument( "--output", "-o", help = "JSON file for the results (default = benchmark_results.json)\n", type = str, dest = "OUTPUT", default = "benchmark_results.json" )
+PARSER.add_argument( "--compare", "-c", help = "JSON results of a previous benchmark to compare with\n", type = str, dest = "COMPARE", default = None )
+PARSER.add_argument( "--keep", "-k", help = "Keep the synthetic data folder\n", dest = "KEEP", action = "store_true" )
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOOL = os.path.join(os.path.dirname(HERE), "AMP_TELEvir_CLI.py")
+STUB_TOOLS = ["medaka_consensus", "medaka", "samtools", "minimap2", "bcftools", "mafft"]
+
+# segments and length per segment of the reference, variants per segment, reads per fastq and metadata rows
+SCALES = { "small":  {"segments": 1,  "length": 10000, "variants": 60,  "reads": 2000,  "read_length": 900, "metadata": 100 },
+           "medium": {"segments": 8,  "length": 2500,  "variants": 20,  "reads": 20000, "read_length": 900, "metadata": 1000 },
+           "large":  {"segments": 12, "length": 25000, "variants": 150, "reads": 60000, "read_length": 900, "metadata": 10000 } }
+
+
+def Import_Tool():
+	sys.path.insert(0, os.path.dirname(TOOL))
+	import AMP_TELEvir_CLI
+	return AMP_TELEvir_CLI
+
+
+def Make_Reference(path, segments, length, seed):
+	# random reference written in 70 columns lines, returns [[seqid, sequence], ...]
+	rng = np.random.default_rng(seed)
+	records = []
+	f = open(path, "w")
+	for i in range(segments):
+		seq = np.frombuffer(b"ACGT", dtype = np.uint8)[rng.integers(0, 4, length)].tobytes().decode()
+		records.append(["segment" + str(i + 1), seq])
+		f.write(">segment" + str(i + 1) + " synthetic segment " + str(i + 1) + "\n")
+		f.write("\n".join([ seq[j:j+70] for j in range(0, length, 70) ]) + "\n")
+	f.close()
+	return records
+
+
+def Make_Fastq(path, reference, reads, meanLength, sdLength, meanQuality, seed):
+	# gzip fastq of reads sampled from the reference, normal lengths and per base qualities around meanQuality
+	rng = np.random.default_rng(seed)
+	f = gzip.open(path, "wb", compresslevel = 1)
+	lengths = np.clip(rng.normal(meanLength, sdLength, reads), 50, None).astype(int)
+	segments = rng.integers(0, len(reference), reads)
+	readQuality = rng.normal(meanQuality, 3, reads)
+	chunk = []
+	for i in range(reads):
+		seq = reference[segments[i]][1]
+		n = min(lengths[i], len(seq))
+		start = int(rng.integers(0, len(seq) - n + 1))
+		qual = (np.clip(rng.normal(readQuality[i], 5, n), 2, 40) + 33).astype(np.uint8).tobytes()
+		chunk.append(b"@read" + str(i).encode() + b" synthetic\n" + seq[start:start + n].encode() + b"\n+\n" + qual + b"\n")
+		if len(chunk) == 5000:
+			f.write(b"".join(chunk))
+			chunk = []
+	f.write(b"".join(chunk))
+	f.close()
+
+
+def Make_Depth(path, reference, meanDepth, seed):
+	# samtools depth -aa style file, with low coverage towards the segment ends
+	rng = np.random.default_rng(seed)
+	f = open(path, "w")
+	for seqid, seq in reference:
+		n = len(seq)
+		values = rng.poisson(meanDepth * np.clip(np.sin(np.linspace(0, np.pi, n)) * 1.6, 0.05, 1.0))
+		f.write("".join([ seqid + "\t" + str(p) + "\t" + str(d) + "\n" for p, d in zip(range(1, n + 1), values.tolist()) ]))
+	f.close()
+
+
+def Make_VCF(path, reference, variants, meanDepth, seed):
+	# medaka tools annotate style VCF, variants evenly spaced, coverage and frequency mixed around the cutoffs
+	sys.path.insert(0, HERE)
+	import stub_tools
+	rng = np.random.default_rng(seed)
+	f = open(path, "w")
+	f.write("##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n")
+	for seqid, seq in reference:
+		step = max(10, len(seq) // (variants + 1))
+		for pos in range(step, len(seq) - 5, step)[:variants]:
+			f.write(stub_tools.Variant_Line(seqid, seq, pos, rng, meanDepth))
+	f.close()
+
+
+def Make_Metadata(path, rows):
+	f = open(path, "w")
+	f.write("Sample ID,File name,Collection date,Origin\n")
+	for i in range(rows):
+		f.write("S" + str(i + 1) + ",barcode" + str(i + 1).zfill(2) + ".fastq.gz,2021-04-" + str(i % 28 + 1).zfill(2) + ",Lisbon\n")
+	f.close()
+
+
+def Apply_Variants(RefSeq, VARIANTS):
+	# consensus of a segment as bcftools consensus makes it from the refined variants
+	parts, last = [], 0
+	if RefSeq[0] in VARIANTS["contigs"]:
+		selected = np.flatnonzero(VARIANTS["contig"] == VARIANTS["contigs"].index(RefSeq[0]))
+		for i in selected:
+			p = int(VARIANTS["pos"][i]) - 1
+			if p < last:
+				continue
+			parts.append(RefSeq[1][last:p])
+			parts.append(VARIANTS["alt"][i].upper())
+			last = p + len(VARIANTS["ref"][i])
+	parts.append(RefSeq[1][last:])
+	return [RefSeq[0], "".join(parts)]
+
+
+def Time_Stage(function, repeats, setup = None):
+	# [best s, median s, last result] of repeated calls, setup (not timed) runs before each call
+	times, result = [], None
+	for i in range(repeats):
+		if setup != None:
+			setup()
+		start = time.perf_counter()
+		result = function()
+		times.append(time.perf_counter() - start)
+	return [min(times), float(np.median(times)), result]
+
+
+def Stage_Record(stage, scale, items, unit, timing, repeats):
+	return { "stage": stage, "scale": scale, "items": items, "unit": unit, "repeats": repeats,
+	         "best_s": round(timing[0], 6), "median_s": round(timing[1], 6),
+	         "items_per_s": round(items / timing[0], 1) if timing[0] > 0 else None }
+
+
+def Bench_Stages(TOOLMODULE, scale, folder, repeats):
+	# times the python side stages on synthetic data of the given scale, returns the stage records
+	S = SCALES[scale]
+	os.makedirs(folder, exist_ok = True)
+	cutoff, ideal, minfreq, maxindel = 30, 200, 0.8, 10*9
+	reference = Make_Reference(folder + "/reference.fasta", S["segments"], S["length"], 1)
+	Make_Fastq(folder + "/reads.fastq.gz", reference, S["reads"], S["read_length"], 300, 12, 2)
+	Make_Depth(folder + "/coverage.depth", reference, 300, 3)
+	Make_VCF(folder + "/variants.vcf", reference, S["variants"], 300, 4)
+	Make_Metadata(folder + "/metadata.csv", S["metadata"])
+	positions = S["segments"] * S["length"]
+	BadRegions = TOOLMODULE.Generate_Bad_regions_index("1:1-100;1:" + str(S["length"] // 2) + "-" + str(S["length"] // 2 + 50), [ seqinfo[0] for seqinfo in reference ])
+	records = []
+
+	timing = Time_Stage(lambda: TOOLMODULE.Reads_Stats(folder + "/reads.fastq.gz"), repeats)
+	records.append(Stage_Record("Reads_Stats", scale, S["reads"], "reads", timing, repeats))
+	timing = Time_Stage(lambda: TOOLMODULE.HQfilterReads(folder + "/reads.fastq.gz", 10, 70, 70, 50, folder + "/reads_HQ.fastq.gz"), repeats)
+	records.append(Stage_Record("HQfilterReads", scale, S["reads"], "reads", timing, repeats))
+
+	VCFlines = S["segments"] * S["variants"]
+	timing = Time_Stage(lambda: TOOLMODULE.Get_Variant_INFO_fromVCF(folder + "/variants.vcf"), repeats)
+	records.append(Stage_Record("Get_Variant_INFO_fromVCF", scale, VCFlines, "variants", timing, repeats))
+	timing = Time_Stage(lambda: TOOLMODULE.Refine_medaka_VCF_with_coverage_and_frequency(folder + "/refined.vcf", cutoff, BadRegions, minfreq, maxindel),
+	                    repeats, lambda: shutil.copyfile(folder + "/variants.vcf", folder + "/refined.vcf"))
+	records.append(Stage_Record("Refine_medaka_VCF_with_coverage_and_frequency", scale, VCFlines, "variants", timing, repeats))
+	VARIANTS = timing[2]
+
+	timing = Time_Stage(lambda: TOOLMODULE.Load_Depth(folder + "/coverage.depth"), repeats,
+	                    lambda: os.path.exists(folder + "/coverage.depth.npz") and os.remove(folder + "/coverage.depth.npz"))
+	records.append(Stage_Record("Load_Depth", scale, positions, "positions", timing, repeats))
+	DEPTH = timing[2]
+
+	consensus = [ Apply_Variants(RefSeq, VARIANTS) for RefSeq in reference ]
+	timing = Time_Stage(lambda: [ TOOLMODULE.Alignment_From_Variants(reference[i], consensus[i], VARIANTS) for i in range(len(reference)) ], repeats)
+	records.append(Stage_Record("Alignment_From_Variants", scale, positions, "positions", timing, repeats))
+	ALIGNMENTS = []
+	for Allign in timing[2]:
+		ALIGNMENTS = ALIGNMENTS + Allign
+	timing = Time_Stage(lambda: TOOLMODULE.LowCov_SeqMasker(ALIGNMENTS, DEPTH, folder + "/masked.fasta", cutoff, BadRegions), repeats)
+	records.append(Stage_Record("LowCov_SeqMasker", scale, positions, "positions", timing, repeats))
+	timing = Time_Stage(lambda: TOOLMODULE.CoverageQuality_Plot(cutoff, ideal, DEPTH, VARIANTS, folder + "/"), repeats)
+	records.append(Stage_Record("CoverageQuality_Plot", scale, positions, "positions", timing, repeats))
+
+	timing = Time_Stage(lambda: TOOLMODULE.METAdataExtract(folder + "/metadata.csv"), repeats)
+	records.append(Stage_Record("METAdataExtract", scale, S["metadata"], "rows", timing, repeats))
+	return records
+
+
+def Stub_Bin(folder):
+	# wrapper executables named as the external tools, calling benchmark/stub_tools.py
+	os.makedirs(folder, exist_ok = True)
+	for tool in STUB_TOOLS:
+		path = folder + "/" + tool
+		f = open(path, "w")
+		f.write("#!/bin/sh\nexec \"" + sys.executable + "\" \"" + HERE + "/stub_tools.py\" " + tool + " \"$@\"\n")
+		f.close()
+		os.chmod(path, 0o755)
+	return folder
+
+
+def Bench_Pipeline(scale, folder, samples, jobs):
+	# full pipeline() run in a separate process with the stub tools first in PATH
+	S = SCALES[scale]
+	os.makedirs(folder + "/reads", exist_ok = True)
+	reference = Make_Reference(folder + "/reference.fasta", S["segments"], S["length"], 11)
+	for i in range(samples):
+		Make_Fastq(folder + "/reads/barcode" + str(i + 1).zfill(2) + ".fastq.gz", reference, S["reads"], S["read_length"], 300, 12, 20 + i)
+	Make_Metadata(folder + "/metadata.csv", samples)
+	env = dict(os.environ)
+	env["PATH"] = Stub_Bin(folder + "/bin") + os.pathsep + env["PATH"]
+	env["MPLBACKEND"] = "Agg"
+	commands = [ sys.executable, TOOL, "-g", folder + "/reference.fasta", "-s", folder + "/reads", "-i", folder + "/metadata.csv",
+	             "-a", "benchmark_run", "-r", folder + "/reference_cache", "-j", str(jobs) ]
+	start = time.perf_counter()
+	process = subprocess.run(commands, env = env, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, universal_newlines = True)
+	wall = time.perf_counter() - start
+	if process.returncode != 0 or "samples failed      =  0" not in process.stdout:
+		print(process.stdout[-3000:])
+		raise RuntimeError("pipeline benchmark run failed (exit status " + str(process.returncode) + ")")
+	record = { "scale": scale, "samples": samples, "jobs": jobs, "reads_per_sample": S["reads"], "wall_s": round(wall, 3),
+	           "samples_per_min": round(samples / wall * 60, 2), "s_per_sample": round(wall / samples, 3) }
+	timings = folder + "/reads/benchmark_run/timings.json"
+	if os.path.exists(timings):
+		record["steps"] = json.load(open(timings))["summary"]
+	return record
+
+
+def Git_Commit():
+	try:
+		return subprocess.run(["git", "-C", os.path.dirname(TOOL), "rev-parse", "--short", "HEAD"], stdout = subprocess.PIPE,
+		                      stderr = subprocess.DEVNULL, universal_newlines = True).stdout.strip()
+	except OSError:
+		return ""
+
+
+def Compare_Results(RESULTS, previousPath):
+	# best time ratios (new / previous) of the stages and pipeline runs found in both results
+	previous = json.load(open(previousPath))
+	old = { (r["stage"], r["scale"]): r for r in previous.get("stages", []) }
+	print("\n%-48s %-8s %12s %12s %8s" % ("stage", "scale", "previous s", "current s", "ratio"))
+	for r in RESULTS["stages"]:
+		if (r["stage"], r["scale"]) in old:
+			before = old[(r["stage"], r["scale"])]["best_s"]
+			print("%-48s %-8s %12.4f %12.4f %8.2f" % (r["stage"], r["scale"], before, r["best_s"], r["best_s"] / before if before > 0 else float("nan")))
+	oldRuns = { (r["scale"], r["samples"], r["jobs"]): r for r in previous.get("pipeline", []) }
+	for r in RESULTS["pipeline"]:
+		key = (r["scale"], r["samples"], r["jobs"])
+		if key in oldRuns:
+			print("%-48s %-8s %12.2f %12.2f %8.2f" % ("pipeline (s per sample)", r["scale"], oldRuns[key]["s_per_sample"], r["s_per_sample"], r["s_per_sample"] / oldRuns[key]["s_per_sample"]))
+
+
+def main():
+	ARGS = PARSER.parse_args()
+	scales = [ scale.strip() for scale in ARGS.SCALES.split(",") if scale.strip() != "" ]
+	for scale in scales:
+		if scale not in SCALES:
+			print("Unknown scale", scale, "( available:", ", ".join(SCALES), ")")
+			exit(0)
+	TOOLMODULE = Import_Tool()
+	workdir = tempfile.mkdtemp(prefix = "TELEvir_benchmark_")
+	RESULTS = { "benchmark": "AMP_TELEvir_CLI", "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": Git_Commit(),
+	            "python": platform.python_version(), "numpy": np.__version__, "machine": platform.platform(), "cpus": os.cpu_count(),
+	            "repeats": ARGS.REPEATS, "stages": [], "pipeline": [] }
+	try:
+		for scale in scales:
+			print(" ...timing the python stages at the", scale, "scale")
+			RESULTS["stages"] = RESULTS["stages"] + Bench_Stages(TOOLMODULE, scale, workdir + "/stages_" + scale, ARGS.REPEATS)
+			if ARGS.SAMPLES > 0:
+				print(" ...running the pipeline on", ARGS.SAMPLES, "samples at the", scale, "scale with stub tools")
+				RESULTS["pipeline"].append(Bench_Pipeline(scale, workdir + "/pipeline_" + scale, ARGS.SAMPLES, ARGS.JOBS))
+	finally:
+		if ARGS.KEEP:
+			print(" synthetic data kept in", workdir)
+		else:
+			shutil.rmtree(workdir, ignore_errors = True)
+	f = open(ARGS.OUTPUT, "w")
+	json.dump(RESULTS, f, indent = 1)
+	f.close()
+	print("\n%-48s %-8s %12s %12s %14s" % ("stage", "scale", "best s", "median s", "items/s"))
+	for r in RESULTS["stages"]:
+		print("%-48s %-8s %12.4f %12.4f %14s" % (r["stage"], r["scale"], r["best_s"], r["median_s"], str(r["items_per_s"]) + " " + r["unit"]))
+	for r in RESULTS["pipeline"]:
+		print("%-48s %-8s %12.2f s   %s samples/min" % ("pipeline (" + str(r["samples"]) + " samples, " + str(r["jobs"]) + " jobs)", r["scale"], r["wall_s"], r["samples_per_min"]))
+	if ARGS.COMPARE != None:
+		Compare_Results(RESULTS, ARGS.COMPARE)
+	print("\nResults written to", ARGS.OUTPUT)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,129 @@
+
+# Equivalence check of the pysam depth engine (Pysam_Depth) against pysam.samtools.depth -aa -d0, on a random
+# BAM written in a temporary folder (all CIGAR operations, soft and hard clips, reads past the contig end, secondary,
+# supplementary, duplicate, qc failed and unmapped reads, a contig without reads), with and without a BAM index,
+# for whole contigs and for regions, and for the depth.gz file written by CoverageExtraction. Runs offline.
+#
+#     python benchmark/check_depth.py [-n reads] [--seed seed]
+#
+# Needs pysam; exits with status 1 when any output differs.
+
+import os
+import sys
+import gzip
+import random
+import shutil
+import argparse
+import tempfile
+
+
+PARSER = argparse.ArgumentParser(description = "Equivalence check of the pysam depth engine against samtools depth -aa -d0")
+PARSER.add_argument( "--reads", "-n", help = "Number of reads in the random BAM (default = 3000)\n", type = int, dest = "READS", default = 3000 )
+PARSER.add_argument( "--seed", help = "Random seed (default = 1)\n", type = int, dest = "SEED", default = 1 )
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOOL = os.path.join(os.path.dirname(HERE), "AMP_TELEvir_CLI.py")
+CONTIGS = [ ["segA", 5000], ["segB", 3000], ["empty", 800] ]
+FLAGS = [0, 0, 0, 0x10, 0x100, 0x800, 0x400, 0x200, 0x10 | 0x800]
+
+
+def Import_Tool():
+	sys.path.insert(0, os.path.dirname(TOOL))
+	import AMP_TELEvir_CLI
+	return AMP_TELEvir_CLI
+
+
+def Random_Read(pysam, name, rng):
+	# aligned read with random CIGAR operations (M, =, X, I, D, N), clips, strand, mapping quality and flags
+	contig = rng.choice([0, 0, 1])
+	operations, span, qlen = [], 0, 0
+	if rng.random() < 0.1:
+		operations.append([5, 20])
+	if rng.random() < 0.3:
+		operations.append([4, rng.randint(1, 30)])
+		qlen = qlen + operations[-1][1]
+	target = rng.randint(50, 1500)
+	while span < target:
+		op, n = rng.choice([0, 0, 0, 7, 8, 1, 2, 3]), rng.randint(1, 40)
+		span = span + (n if op in [0, 7, 8, 2, 3] else 0)
+		qlen = qlen + (n if op in [0, 7, 8, 1] else 0)
+		operations.append([op, n])
+	operations.append([0, 5])
+	qlen = qlen + 5
+	if rng.random() < 0.3:
+		operations.append([4, rng.randint(1, 30)])
+		qlen = qlen + operations[-1][1]
+	read = pysam.AlignedSegment()
+	read.query_name = name
+	read.reference_id = contig
+	read.reference_start = rng.randint(0, CONTIGS[contig][1] - 50)      # long reads run past the contig end
+	read.cigartuples = [ tuple(operation) for operation in operations ]
+	read.query_sequence = "A"*qlen
+	read.query_qualities = pysam.qualitystring_to_array("+"*qlen)
+	read.mapping_quality = rng.choice([0, 60])
+	read.flag = rng.choice(FLAGS)
+	return read
+
+
+def Write_BAMs(pysam, folder, reads, rng):
+	# [indexed bam, bam without index] with the same sorted reads
+	header = { "HD": { "VN": "1.6", "SO": "coordinate" }, "SQ": [ { "SN": contig, "LN": length } for contig, length in CONTIGS ] }
+	with pysam.AlignmentFile(folder + "/raw.bam", "wb", header = header) as f:
+		for i in range(reads):
+			f.write(Random_Read(pysam, "r" + str(i), rng))
+		unmapped = pysam.AlignedSegment()
+		unmapped.query_name, unmapped.flag, unmapped.reference_id, unmapped.reference_start = "unmapped", 4, -1, -1
+		unmapped.query_sequence = "ACGT"
+		unmapped.query_qualities = pysam.qualitystring_to_array("++++")
+		f.write(unmapped)
+	pysam.sort("-o", folder + "/calls_to_draft.bam", folder + "/raw.bam")
+	pysam.index(folder + "/calls_to_draft.bam")
+	shutil.copyfile(folder + "/calls_to_draft.bam", folder + "/noindex.bam")
+	return [folder + "/calls_to_draft.bam", folder + "/noindex.bam"]
+
+
+def Depth_Text(DEPTH):
+	# depth arrays as samtools depth lines
+	return "".join([ contig + "\t" + str(p) + "\t" + str(x) + "\n" for contig, P, X in zip(DEPTH["contigs"], DEPTH["pos"], DEPTH["depth"]) for p, x in zip(P.tolist(), X.tolist()) ])
+
+
+def main():
+	ARGS = PARSER.parse_args()
+	try:
+		import pysam
+	except ImportError:
+		print("The depth check needs the pysam package (pip install pysam)")
+		exit(0)
+	TOOLMODULE = Import_Tool()
+	rng = random.Random(ARGS.SEED)
+	folder = tempfile.mkdtemp(prefix = "TELEvir_depth_")
+	failed = []
+	try:
+		indexed, unindexed = Write_BAMs(pysam, folder, ARGS.READS, rng)
+		expected = pysam.samtools.depth("-aa", "-d0", indexed)
+		CHECKS = [ ["whole contigs, indexed", TOOLMODULE.Pysam_Depth(indexed), expected],
+		           ["whole contigs, no index", TOOLMODULE.Pysam_Depth(unindexed), expected] ]
+		for contig, length in CONTIGS:
+			start = rng.randint(1, length)
+			end = rng.randint(start, length)
+			region = contig + ":" + str(start) + "-" + str(end)
+			CHECKS.append([ "region " + region, TOOLMODULE.Pysam_Depth(indexed, [[contig, start, end]]), pysam.samtools.depth("-aa", "-d0", "-r", region, indexed) ])
+		for name, DEPTH, samtools in CHECKS:
+			if Depth_Text(DEPTH) != samtools:
+				failed.append(name)
+		DepthFile, DEPTH = TOOLMODULE.CoverageExtraction(indexed, "pysam")
+		with gzip.open(DepthFile, "rt") as f:
+			if f.read() != expected:
+				failed.append("depth.gz of CoverageExtraction")
+		if Depth_Text(TOOLMODULE.Load_Depth(DepthFile)) != expected:
+			failed.append("depth arrays loaded back")
+	finally:
+		shutil.rmtree(folder, ignore_errors = True)
+	print(len(CHECKS) + 2, "depth outputs compared with samtools depth -aa -d0 ( pysam", pysam.__version__, "),", len(failed), "differences")
+	for name in failed:
+		print("\tdiffers:", name)
+	exit(1 if len(failed) > 0 else 0)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,201 @@
+
+# Equivalence check of the vectorized LowCov_SeqMasker against the per character loop it replaced, on random
+# synthetic reference/sample alignments (reference gaps, sample gaps, sample rows shorter than the reference row,
+# depth arrays one position too long or too short, several segments).
+# The ignore regions are checked apart, against a per column loop with the interval rules of the ignore regions
+# index (bases in a region are masked, insertions take the position of the next reference base).
+#
+#     python benchmark/check_masking.py [-n cases] [--seed seed]
+#
+# Exits with status 1 when any case differs.
+
+import os
+import sys
+import argparse
+import tempfile
+import numpy as np
+
+
+PARSER = argparse.ArgumentParser(description = "Equivalence check of LowCov_SeqMasker on synthetic alignments")
+PARSER.add_argument( "--cases", "-n", help = "Number of random alignments (default = 400)\n", type = int, dest = "CASES", default = 400 )
+PARSER.add_argument( "--seed", help = "Random seed (default = 0)\n", type = int, dest = "SEED", default = 0 )
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOOL = os.path.join(os.path.dirname(HERE), "AMP_TELEvir_CLI.py")
+
+
+def Import_Tool():
+	sys.path.insert(0, os.path.dirname(TOOL))
+	import AMP_TELEvir_CLI
+	return AMP_TELEvir_CLI
+
+
+def Old_LowCov_SeqMasker(AlignSequences, DEPTH , output_fasta, cutoff, Bad_regions) :
+	# frozen copy of the per character implementation (Bad_regions was a list of alignment counts, always empty here)
+	Ncount, missmatch = 0, 0
+	depths = [ values.tolist() for values in DEPTH["depth"] ]
+	RefSeq, SampleSeq, SeqID = [], [], []
+	for seq in AlignSequences:
+		if seq[0].find("Reference") > -1:
+			RefSeq.append(seq[1])
+		if seq[0].find("Sample") > -1:
+			SampleSeq.append(seq[1])
+			SeqID.append(seq[0])
+	sequences_masked = [ ]
+	SeqLenght = 0
+	for i, seq in enumerate(RefSeq):
+		seq2 = ""
+		k = 0
+		for j, rB in enumerate(seq):
+			icov = float(depths[i][k])
+			sB =""
+			if j < len (SampleSeq[i]):
+				sB = SampleSeq[i][j]
+			if rB != "-":
+				if k < len(depths[i]) -1 :
+					k = k + 1
+				if sB != "-":
+					SeqLenght = SeqLenght+1
+					if icov < cutoff or SeqLenght in Bad_regions:
+						sB = "N"
+						Ncount = Ncount+1
+					seq2 = seq2 + sB
+			if rB == "-" and sB != "-":
+				SeqLenght = SeqLenght + 1
+				if SeqLenght in Bad_regions and icov < cutoff:
+					sB = "N"
+					Ncount = Ncount+1
+				seq2 = seq2 + sB
+				missmatch = missmatch + 1
+			if rB != "-" and sB == "-":
+				 missmatch = missmatch + 1
+		seq2 = seq2.replace("\n", "" )
+		sequences_masked.append(seq2)
+	File2 = open(output_fasta, 'w')
+	for i, seq in enumerate(sequences_masked):
+		File2.write( ">" + SeqID[i] + "\n" )
+		File2.write(seq + "\n")
+	File2.close()
+	return [Ncount, SeqLenght, round(Ncount/SeqLenght*100, 2 ), missmatch ]
+
+
+def Region_Masker(AlignSequences, DEPTH, cutoff, Bad_regions):
+	# per column masking with ignore regions given as {contig: [starts, ends]} (1 based, inclusive)
+	# returns [Ncount, SeqLenght, missmatch, [masked sequences]]
+	Ncount, SeqLenght, missmatch, sequences = 0, 0, 0, []
+	for i in range(0, len(AlignSequences), 2):
+		ref, sample = AlignSequences[i][1], AlignSequences[i+1][1]
+		contig = DEPTH["contigs"][i//2]
+		depth = DEPTH["depth"][i//2].tolist()
+		starts, ends = Bad_regions.get(contig, [[], []])
+		k, seq2 = 0, []
+		for j, rB in enumerate(ref):
+			# columns past the end of a short sample row are empty, counted like the old loop did ("" is not a gap)
+			sB = sample[j] if j < len(sample) else ""
+			cov = depth[min(k, len(depth) - 1)]
+			bad = any([ s <= k + 1 <= e for s, e in zip(starts, ends) ])
+			if (rB != "-") != (sB != "-"):
+				missmatch = missmatch + 1
+			if sB != "-":
+				SeqLenght = SeqLenght + 1
+				if (rB != "-" and cov < cutoff) or bad:
+					sB = "N"
+					Ncount = Ncount + 1
+				seq2.append(sB)
+			if rB != "-":
+				k = k + 1
+		sequences.append("".join(seq2))
+	return [Ncount, SeqLenght, missmatch, sequences]
+
+
+def Random_Case(rng):
+	# [alignments, DEPTH, cutoff] of 1 to 3 segments
+	ALIGNMENTS, DEPTH = [], { "contigs": [], "pos": [], "depth": [] }
+	for segment in range(int(rng.integers(1, 4))):
+		n = int(rng.integers(5, 120))
+		ref, sample = [], []
+		for base in rng.choice(list("ACGT"), n):
+			kind = rng.random()
+			if kind < 0.1:
+				ref.append("-")
+				sample.append(str(rng.choice(list("ACGT"))))     # insertion in the sample
+			elif kind < 0.2:
+				ref.append(str(base))
+				sample.append("-")                                # deletion in the sample
+			else:
+				ref.append(str(base))
+				sample.append(str(rng.choice(list("ACGT"))) if rng.random() < 0.1 else str(base))
+		if rng.random() < 0.2:
+			sample = sample[:int(rng.integers(1, len(sample) + 1))]   # sample row shorter than the reference row
+		bases = max(1, sum([ base != "-" for base in ref ]) + int(rng.choice([-1, 0, 0, 1])))
+		ALIGNMENTS = ALIGNMENTS + [ ["Reference", "".join(ref)], ["Sample", "".join(sample)] ]
+		DEPTH["contigs"].append("seg" + str(segment))
+		DEPTH["pos"].append(np.arange(1, bases + 1, dtype = np.int32))
+		DEPTH["depth"].append(rng.integers(0, 60, bases).astype(np.int32))
+	return [ALIGNMENTS, DEPTH, int(rng.integers(1, 50))]
+
+
+def Random_Regions(rng, DEPTH):
+	regions = {}
+	for contig, positions in zip(DEPTH["contigs"], DEPTH["pos"]):
+		if rng.random() < 0.7:
+			starts = np.sort(rng.choice(np.arange(1, len(positions) + 2), min(3, len(positions) + 1), replace = False))
+			regions[contig] = [ starts.tolist(), (starts + rng.integers(0, 5, len(starts))).tolist() ]
+			# merged and sorted, as Generate_Bad_regions_index returns them
+			merged = []
+			for s, e in zip(*regions[contig]):
+				if len(merged) > 0 and s <= merged[-1][1] + 1:
+					merged[-1][1] = max(merged[-1][1], e)
+				else:
+					merged.append([s, e])
+			regions[contig] = [ [ s for s, e in merged ], [ e for s, e in merged ] ]
+	return regions
+
+
+def Read_Output(path):
+	f = open(path)
+	text = f.read()
+	f.close()
+	return text
+
+
+def main():
+	ARGS = PARSER.parse_args()
+	TOOLMODULE = Import_Tool()
+	rng = np.random.default_rng(ARGS.SEED)
+	folder = tempfile.mkdtemp(prefix = "TELEvir_masking_")
+	failed = 0
+	for case in range(ARGS.CASES):
+		ALIGNMENTS, DEPTH, cutoff = Random_Case(rng)
+		old = Old_LowCov_SeqMasker(ALIGNMENTS, DEPTH, folder + "/old.fasta", cutoff, [])
+		new = TOOLMODULE.LowCov_SeqMasker(ALIGNMENTS, DEPTH, folder + "/new.fasta", cutoff, {})
+		if old != new or Read_Output(folder + "/old.fasta") != Read_Output(folder + "/new.fasta"):
+			print("case", case, "differs from the per character loop:", old, new)
+			failed = failed + 1
+		# the same alignments labelled by segment ID, with the depth arrays in another order
+		order = rng.permutation(len(DEPTH["contigs"]))
+		LABELLED = []
+		for i in range(0, len(ALIGNMENTS), 2):
+			contig = DEPTH["contigs"][i//2]
+			LABELLED = LABELLED + [ ["Reference " + contig, ALIGNMENTS[i][1]], ["Sample " + contig, ALIGNMENTS[i+1][1]] ]
+		SHUFFLED = { key: [ DEPTH[key][i] for i in order ] for key in ["contigs", "pos", "depth"] }
+		if TOOLMODULE.LowCov_SeqMasker(LABELLED, SHUFFLED, folder + "/labelled.fasta", cutoff, {}) != old:
+			print("case", case, "differs when the depth arrays are found by segment ID")
+			failed = failed + 1
+		regions = Random_Regions(rng, DEPTH)
+		expected = Region_Masker(ALIGNMENTS, DEPTH, cutoff, regions)
+		new = TOOLMODULE.LowCov_SeqMasker(LABELLED, DEPTH, folder + "/regions.fasta", cutoff, regions)
+		masked = [ line for line in Read_Output(folder + "/regions.fasta").split("\n")[1::2] ]
+		if [new[0], new[1], new[3]] != expected[:3] or masked != expected[3]:
+			print("case", case, "differs with ignore regions", regions, ":", new, expected[:3])
+			failed = failed + 1
+	for name in ["old", "new", "labelled", "regions"]:
+		if os.path.exists(folder + "/" + name + ".fasta"):
+			os.remove(folder + "/" + name + ".fasta")
+	os.rmdir(folder)
+	print(ARGS.CASES, "random alignments,", failed, "differences")
+	exit(1 if failed > 0 else 0)
+
+
+if __name__ == "__main__":
+	main()
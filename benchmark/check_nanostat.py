@@ -0,0 +1,103 @@
+
+# Equivalence check of the in-process reads statistics and filter against the tools they replaced, on a random
+# gzip fastq written in a temporary folder (reads of random lengths and quality profiles, reads of a single quality
+# value, whose average quality falls on an integer, and reads shorter than the filter length):
+#  * Reads_Stats and the raw and filtered stats of HQfilterReads against NanoStat --fastq --tsv (number of reads,
+#    number of bases, mean read length, read length stdev and mean_qual)
+#  * the HQfilterReads output against  gunzip -c | NanoFilt -q Q -l L --headcrop H --tailcrop T  (byte identical)
+#
+#     python benchmark/check_nanostat.py [-n reads] [--seed seed]
+#
+# Needs NanoStat and NanoFilt in the PATH; exits with status 1 when any value differs.
+
+import os
+import sys
+import gzip
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+PARSER = argparse.ArgumentParser(description = "Equivalence check of the reads statistics and filter against NanoStat and NanoFilt")
+PARSER.add_argument( "--reads", "-n", help = "Number of reads in the random fastq (default = 2000)\n", type = int, dest = "READS", default = 2000 )
+PARSER.add_argument( "--seed", help = "Random seed (default = 3)\n", type = int, dest = "SEED", default = 3 )
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOOL = os.path.join(os.path.dirname(HERE), "AMP_TELEvir_CLI.py")
+# [Q, headcrop, tailcrop, minimum length]; no tailcrop 0, NanoFilt 2.6 writes empty reads for it (seq[:-0]) where
+# HQfilterReads keeps the whole read
+FILTERS = [ [7, 30, 20, 100], [10, 0, 1, 0], [12, 50, 50, 500] ]
+NANOSTAT = { "number_of_reads": 3, "number_of_bases": 4, "mean_read_length": 0, "read_length_stdev": 1, "mean_qual": 2 }
+
+
+def Import_Tool():
+	sys.path.insert(0, os.path.dirname(TOOL))
+	import AMP_TELEvir_CLI
+	return AMP_TELEvir_CLI
+
+
+def Write_Fastq(path, reads, rng):
+	f = gzip.open(path, "wt")
+	for i in range(reads):
+		n = rng.choice([rng.randint(1, 300), rng.randint(200, 3000), rng.randint(200, 3000)])
+		if rng.random() < 0.1:
+			qual = chr(33 + rng.randint(3, 20))*n          # single quality value, average quality on an integer
+		else:
+			center = rng.uniform(6, 24)
+			qual = "".join([ chr(33 + max(0, min(60, int(rng.gauss(center, 3))))) for j in range(n) ])
+		f.write("@read" + str(i) + " runid=check\n" + "".join([ rng.choice("ACGT") for j in range(n) ]) + "\n+\n" + qual + "\n")
+	f.close()
+
+
+def NanoStat(path):
+	# [mean length, length stdev, mean quality, number of reads, number of bases] from NanoStat --tsv
+	output = subprocess.run(["NanoStat", "--fastq", path, "--tsv"], stdout = subprocess.PIPE, check = True, universal_newlines = True).stdout
+	STATS = [None]*5
+	for line in output.split("\n"):
+		fields = line.split("\t")
+		if fields[0] in NANOSTAT:
+			STATS[NANOSTAT[fields[0]]] = float(fields[1])
+	return STATS
+
+
+def Compare(name, stats, expected, failed):
+	if [ float(value) for value in stats ] != expected:
+		failed.append(name + ": " + str(stats) + " NanoStat " + str(expected))
+
+
+def main():
+	ARGS = PARSER.parse_args()
+	if shutil.which("NanoStat") == None or shutil.which("NanoFilt") == None:
+		print("The reads statistics check needs NanoStat and NanoFilt in the PATH (pip install NanoStat NanoFilt)")
+		exit(0)
+	TOOLMODULE = Import_Tool()
+	rng = random.Random(ARGS.SEED)
+	folder = tempfile.mkdtemp(prefix = "TELEvir_nanostat_")
+	failed = []
+	try:
+		reads = folder + "/barcode01.fastq.gz"
+		Write_Fastq(reads, ARGS.READS, rng)
+		raw = NanoStat(reads)
+		Compare("Reads_Stats", TOOLMODULE.Reads_Stats(reads), raw, failed)
+		for Q, H, T, L in FILTERS:
+			name = "filter -q " + str(Q) + " --headcrop " + str(H) + " --tailcrop " + str(T) + " -l " + str(L)
+			HQfile, rawStats, hqStats = TOOLMODULE.HQfilterReads(reads, Q, H, T, L, folder + "/barcode01_HQ.fastq.gz")
+			subprocess.run("gunzip -c " + reads + " | NanoFilt -q " + str(Q) + " -l " + str(L) + " --headcrop " + str(H) + " --tailcrop " + str(T) +
+			               " | gzip > " + folder + "/nanofilt.fastq.gz", shell = True, check = True)
+			Compare(name + ", raw stats", rawStats, raw, failed)
+			Compare(name + ", filtered stats", hqStats, NanoStat(folder + "/nanofilt.fastq.gz"), failed)
+			with gzip.open(HQfile, "rb") as ours, gzip.open(folder + "/nanofilt.fastq.gz", "rb") as nanofilt:
+				if ours.read() != nanofilt.read():
+					failed.append(name + ": filtered fastq differs from NanoFilt")
+	finally:
+		shutil.rmtree(folder, ignore_errors = True)
+	print(1 + 3*len(FILTERS), "reads statistics and", len(FILTERS), "filtered fastq compared with NanoStat and NanoFilt,", len(failed), "differences")
+	for name in failed:
+		print("\tdiffers:", name)
+	exit(1 if len(failed) > 0 else 0)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,152 @@
+
+# Stand-ins for the external tools of the pipeline (medaka_consensus, medaka, samtools, minimap2, bcftools, mafft)
+# used by the benchmark, so the python side of the pipeline can be timed without the real tools installed.
+# Each tool is a small wrapper script calling:  python stub_tools.py <tool> <arguments>
+# Outputs have the formats the pipeline reads; their contents are synthetic and deterministic.
+
+import os
+import sys
+import gzip
+import shutil
+import numpy as np
+
+
+def Read_Fasta(path):
+	records = []
+	f = gzip.open(path, "rt") if path.endswith(".gz") else open(path)
+	for line in f:
+		line = line.strip()
+		if line.startswith(">"):
+			records.append([line[1:].split()[0], []])
+		elif line != "" and len(records) > 0:
+			records[-1][1].append(line)
+	f.close()
+	return [ [seqid, "".join(lines)] for seqid, lines in records ]
+
+
+def Write_Fasta(path, records):
+	f = open(path, "w")
+	for seqid, seq in records:
+		f.write(">" + seqid + "\n" + seq + "\n")
+	f.close()
+
+
+def Fake_Bam(path):
+	# the fake bam carries the reference path and the depth settings for samtools depth
+	f = open(path)
+	ref, depth, seed = f.read().split("\t")
+	f.close()
+	return [ref, int(depth), int(seed)]
+
+
+def Medaka_Consensus(args):
+	reads, ref, output = args[args.index("-i") + 1], args[args.index("-d") + 1], args[args.index("-o") + 1]
+	os.makedirs(output, exist_ok = True)
+	f = open(output + "/calls_to_draft.bam", "w")
+	f.write(ref + "\t" + os.environ.get("STUB_DEPTH", "300") + "\t" + str(len(reads)))
+	f.close()
+	open(output + "/consensus_probs.hdf", "w").close()
+	shutil.copyfile(ref, output + "/consensus.fasta")
+
+
+def Samtools_Depth(bam):
+	# samtools depth -aa style output: every position of every reference sequence
+	ref, depth, seed = Fake_Bam(bam)
+	rng = np.random.default_rng(seed)
+	out = sys.stdout
+	for seqid, seq in Read_Fasta(ref):
+		n = len(seq)
+		profile = np.clip(np.sin(np.linspace(0, np.pi, n)) * 1.6, 0.05, 1.0)   # low coverage towards the segment ends
+		values = rng.poisson(depth * profile)
+		out.write("".join([ seqid + "\t" + str(p) + "\t" + str(d) + "\n" for p, d in zip(range(1, n + 1), values.tolist()) ]))
+
+
+def Medaka_Variants(ref, bam, output):
+	# medaka tools annotate style VCF: SNPs, small deletions and insertions with DP, DPSP, SR and AR fields
+	refpath, depth, seed = Fake_Bam(bam)
+	rng = np.random.default_rng(seed)
+	step = int(os.environ.get("STUB_VARIANT_SPACING", "150"))
+	f = open(output, "w")
+	f.write("##fileformat=VCFv4.1\n##source=medaka stub\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n")
+	for seqid, seq in Read_Fasta(ref):
+		for pos in range(step // 2, len(seq) - 5, step):
+			f.write(Variant_Line(seqid, seq, pos, rng, depth))
+	f.close()
+
+
+def Variant_Line(seqid, seq, pos, rng, depth):
+	base = seq[pos - 1].upper()
+	kind = rng.random()
+	if kind < 0.8:
+		REF, ALT = base, "ACGT"[("ACGT".index(base) + 1 + int(rng.integers(3))) % 4] if base in "ACGT" else "A"
+	elif kind < 0.9:
+		REF, ALT = seq[pos - 1:pos + 2].upper(), base
+	else:
+		REF, ALT = base, base + "".join(rng.choice(list("ACGT"), 2))
+	DP = int(rng.integers(depth // 10, depth * 2))
+	alt = int(DP * rng.uniform(0.5, 1.0))
+	SR = [ (DP - alt) // 2, DP - alt - (DP - alt) // 2, alt // 2, alt - alt // 2 ]
+	INFO = "AR=0,0;DP=" + str(DP) + ";DPS=" + str(DP // 2) + "," + str(DP - DP // 2) + ";DPSP=" + str(DP) + ";SC=1,1,1,1;SR=" + ",".join([ str(v) for v in SR ])
+	return "\t".join([seqid, str(pos), ".", REF, ALT, "30", "PASS", INFO, "GT:GQ", "1:30"]) + "\n"
+
+
+def Bcftools_Consensus(vcf, ref, output):
+	# applies the VCF records (already sorted and not overlapping) to the reference
+	records = Read_Fasta(ref)
+	variants = {}
+	f = gzip.open(vcf, "rt") if vcf.endswith(".gz") else open(vcf)
+	for line in f:
+		if line[0] != "#":
+			fields = line.split("\t")
+			variants.setdefault(fields[0], []).append([int(fields[1]), fields[3], fields[4]])
+	f.close()
+	consensus = []
+	for seqid, seq in records:
+		parts, last = [], 0
+		for pos, REF, ALT in variants.get(seqid, []):
+			if pos - 1 < last:
+				continue
+			parts.append(seq[last:pos - 1])
+			parts.append(ALT)
+			last = pos - 1 + len(REF)
+		parts.append(seq[last:])
+		consensus.append([seqid, "".join(parts)])
+	Write_Fasta(output, consensus)
+
+
+def Mafft(path):
+	# pads the shorter sequence with gaps (enough for the timing, the pipeline only aligns with mafft on request)
+	(id1, s1), (id2, s2) = Read_Fasta(path)
+	n = max(len(s1), len(s2))
+	sys.stdout.write(">" + id1 + "\n" + s1.ljust(n, "-") + "\n>" + id2 + "\n" + s2.ljust(n, "-") + "\n")
+
+
+def main(tool, args):
+	if tool == "medaka_consensus":
+		Medaka_Consensus(args)
+	elif tool == "medaka" and args[0] == "variant":
+		open(args[-1], "w").write("##fileformat=VCFv4.1\n")
+	elif tool == "medaka" and args[0] == "tools":
+		Medaka_Variants(args[-3], args[-2], args[-1])
+	elif tool == "samtools" and args[0] == "faidx":
+		open(args[1] + ".fai", "w").close()
+	elif tool == "samtools" and args[0] == "depth":
+		Samtools_Depth(args[-1])
+	elif tool == "minimap2":
+		open(args[args.index("-d") + 1], "w").close()
+	elif tool == "bcftools" and args[0] == "convert":
+		with open(args[-1], "rb") as vcf, gzip.open(args[args.index("-o") + 1], "wb") as vcfgz:
+			shutil.copyfileobj(vcf, vcfgz)
+	elif tool == "bcftools" and args[0] == "index":
+		pass
+	elif tool == "bcftools" and args[0] == "consensus":
+		Bcftools_Consensus(args[1], args[args.index("-f") + 1], args[args.index("-o") + 1])
+	elif tool == "mafft":
+		Mafft(args[-1])
+	else:
+		sys.stderr.write("stub_tools: unsupported command " + tool + " " + " ".join(args) + "\n")
+		exit(1)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1], sys.argv[2:])